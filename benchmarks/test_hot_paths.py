@@ -0,0 +1,235 @@
+import datetime
+from os import environ
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+import xarray as xr
+from rasterio import transform
+from sklearn import linear_model
+
+from lausanne_heat_islands import make_biophysical_table_shade, utils
+from lausanne_heat_islands.regression import make_regression_df
+from lausanne_heat_islands.regression import make_tair_regr_maps
+from lausanne_heat_islands.regression import utils as regr_utils
+
+# micro-benchmarks (pytest-benchmark) of the hot paths of the pipeline on
+# synthetic data, so that they run offline. The side length (in pixels) of the
+# synthetic rasters is parametrized by the comma-separated
+# `BENCHMARK_SIZES` environment variable. Use `make benchmark` to save the
+# results (to `.benchmarks`) and compare them with those of the previous run
+SIZES = [int(size) for size in environ.get('BENCHMARK_SIZES',
+                                           '128,512').split(',')]
+NUM_DATES = 4
+NUM_STATIONS = 12
+# (approximate) resolutions of the actual inputs
+LULC_RES = 10
+TREE_CANOPY_RES = 1
+# lower-left corner of the synthetic grids (within the Lausanne agglomeration)
+WEST, SOUTH = 2530000, 1145000
+RANDOM_STATE = 0
+
+
+def _get_dates():
+    return pd.date_range(datetime.date(2018, 7, 1), periods=NUM_DATES)
+
+
+def _get_feature_da(size, res, name='lst', nan_frac=.05):
+    # (time, y, x) data array with salem's georeferencing attributes and a
+    # fraction `nan_frac` of missing pixels (e.g., clouds)
+    random_state = np.random.RandomState(RANDOM_STATE)
+    arr = random_state.normal(300, 5, (NUM_DATES, size, size)).astype(
+        np.float32)
+    arr[random_state.random_sample(arr.shape) < nan_frac] = np.nan
+    return xr.DataArray(arr,
+                        dims=('time', 'y', 'x'),
+                        coords={
+                            'time': _get_dates(),
+                            'y': SOUTH + res * (size - np.arange(size) - .5),
+                            'x': WEST + res * (np.arange(size) + .5)
+                        },
+                        name=name,
+                        attrs={'pyproj_srs': utils.CRS})
+
+
+def _get_station_location_gser(size, res):
+    # stations at random locations of the grid, away from its borders
+    random_state = np.random.RandomState(RANDOM_STATE)
+    x, y = (coord + res * random_state.uniform(.1 * size, .9 * size,
+                                               NUM_STATIONS)
+            for coord in (WEST, SOUTH))
+    return gpd.GeoSeries(gpd.points_from_xy(x, y), crs=utils.CRS)
+
+
+def _get_station_tair_df():
+    random_state = np.random.RandomState(RANDOM_STATE)
+    return pd.DataFrame(random_state.normal(20, 3, (NUM_DATES, NUM_STATIONS)),
+                        index=_get_dates(),
+                        columns=[f'station-{i}' for i in range(NUM_STATIONS)])
+
+
+def _dump_raster(arr, res, dst_filepath, west=WEST):
+    height, width = arr.shape
+    with rio.open(dst_filepath,
+                  'w',
+                  driver='GTiff',
+                  dtype=arr.dtype,
+                  width=width,
+                  height=height,
+                  count=1,
+                  crs=utils.CRS,
+                  transform=transform.from_origin(west, SOUTH + res * height,
+                                                  res, res)) as dst:
+        dst.write(arr, 1)
+
+
+# fixtures
+@pytest.fixture(scope='module', params=SIZES)
+def tree_cover_filepaths(request, tmp_path_factory):
+    # LULC raster of `size` pixels and a tree canopy raster covering it, both
+    # aligned and misaligned (by half a tree canopy pixel) with the LULC grid
+    # to benchmark both the block-averaging and the resampling paths
+    size = request.param
+    tmp_dir = tmp_path_factory.mktemp(f'tree-cover-{size}')
+    random_state = np.random.RandomState(RANDOM_STATE)
+    lulc_filepath = str(tmp_dir / 'lulc.tif')
+    _dump_raster(random_state.randint(1, 10, (size, size), dtype=np.uint8),
+                 LULC_RES, lulc_filepath)
+    canopy_size = size * LULC_RES // TREE_CANOPY_RES
+    canopy_arr = (random_state.random_sample(
+        (canopy_size, canopy_size)) < .3).astype(np.uint8)
+    tree_canopy_filepaths = {}
+    for alignment, west in [('aligned', WEST),
+                            ('misaligned', WEST + TREE_CANOPY_RES / 2)]:
+        tree_canopy_filepaths[alignment] = str(tmp_dir /
+                                               f'tree-canopy-{alignment}.tif')
+        _dump_raster(canopy_arr,
+                     TREE_CANOPY_RES,
+                     tree_canopy_filepaths[alignment],
+                     west=west)
+    return lulc_filepath, tree_canopy_filepaths
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def landsat_feature_da(request):
+    return _get_feature_da(request.param, regr_utils.LANDSAT_RES)
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def landsat_features_ds(request):
+    # dataset with all the (spatially averaged) landsat features
+    return xr.Dataset({
+        landsat_feature: _get_feature_da(request.param,
+                                         regr_utils.LANDSAT_RES,
+                                         name=landsat_feature)
+        for landsat_feature in regr_utils.LANDSAT_FEATURES
+    })
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def ref_et_filepath(request, tmp_path_factory):
+    size = request.param
+    tmp_dir = tmp_path_factory.mktemp(f'ref-et-{size}')
+    ref_et_filepath = str(tmp_dir / 'ref-et.nc')
+    utils.dump_dataset(_get_feature_da(size, LULC_RES, name='ref_et'),
+                       ref_et_filepath)
+    return ref_et_filepath
+
+
+@pytest.fixture(scope='module')
+def kernel_dict():
+    return regr_utils.get_kernel_dict()
+
+
+# benchmarks
+@pytest.mark.benchmark(group='get_tree_cover_arr')
+@pytest.mark.parametrize('alignment', ['aligned', 'misaligned'])
+def test_get_tree_cover_arr(benchmark, tree_cover_filepaths, alignment):
+    lulc_filepath, tree_canopy_filepaths = tree_cover_filepaths
+    with rio.open(lulc_filepath) as lulc_src, rio.open(
+            tree_canopy_filepaths[alignment]) as tree_canopy_src:
+        tree_cover_arr = benchmark(
+            make_biophysical_table_shade.get_tree_cover_arr, lulc_src,
+            tree_canopy_src)
+        assert tree_cover_arr.shape == lulc_src.shape
+
+
+@pytest.mark.benchmark(group='get_kernel_dict')
+@pytest.mark.parametrize('res', [regr_utils.LANDSAT_RES, LULC_RES])
+def test_get_kernel_dict(benchmark, res):
+    kernel_dict = benchmark(regr_utils.get_kernel_dict, res=res)
+    assert len(kernel_dict) == len(regr_utils.AVERAGING_RADII) - 1
+
+
+@pytest.mark.benchmark(group='_get_circular_kernel')
+@pytest.mark.parametrize('radius', [20, 80])
+def test_get_circular_kernel(benchmark, radius):
+    kernel_arr = benchmark(regr_utils._get_circular_kernel, radius)
+    assert kernel_arr.shape == (2 * radius + 1, 2 * radius + 1)
+
+
+@pytest.mark.benchmark(group='get_savg_feature_arr')
+def test_get_savg_feature_arr(benchmark, landsat_feature_da, kernel_dict):
+    size = landsat_feature_da.sizes['x']
+    landsat_feature_arr = benchmark(
+        make_regression_df.get_savg_feature_arr, landsat_feature_da,
+        _get_station_tair_df(),
+        _get_station_location_gser(size, regr_utils.LANDSAT_RES), kernel_dict)
+    assert landsat_feature_arr.shape == (NUM_STATIONS, NUM_DATES,
+                                         len(regr_utils.AVERAGING_RADII))
+
+
+@pytest.mark.benchmark(group='get_savg_arr_at')
+def test_get_savg_arr_at(benchmark, landsat_feature_da, kernel_dict):
+    # the averages at the station pixels (plus pixels at the borders of the
+    # grid, whose windows are partly outside it) must match the averaged
+    # rasters of `get_savg_arr`, including the handling of the nan pixels
+    size = landsat_feature_da.sizes['x']
+    station_location_gser = _get_station_location_gser(
+        size, regr_utils.LANDSAT_RES)
+    cols, rows = landsat_feature_da.salem.grid.transform(
+        station_location_gser.x,
+        station_location_gser.y,
+        crs=station_location_gser.crs,
+        nearest=True)
+    rows = np.concatenate([np.asarray(rows).ravel(), [0, size - 1, 1]])
+    cols = np.concatenate([np.asarray(cols).ravel(), [size - 1, 0, 2]])
+    savg_arr = benchmark(regr_utils.get_savg_arr_at, landsat_feature_da,
+                         rows, cols, kernel_dict)
+    np.testing.assert_allclose(
+        savg_arr,
+        regr_utils.get_savg_arr(landsat_feature_da.values,
+                                kernel_dict)[..., rows, cols],
+        rtol=1e-6)
+
+
+@pytest.mark.benchmark(group='get_savg_feature_ds')
+def test_get_savg_feature_ds(benchmark, landsat_feature_da, kernel_dict):
+    savg_feature_ds = benchmark(make_tair_regr_maps.get_savg_feature_ds,
+                                landsat_feature_da, kernel_dict)
+    assert len(savg_feature_ds.data_vars) == len(regr_utils.AVERAGING_RADII)
+
+
+@pytest.mark.benchmark(group='predict_T')
+def test_predict_T(benchmark, landsat_features_ds):
+    # the actual regressor is a linear regression (see `make_regressor`)
+    random_state = np.random.RandomState(RANDOM_STATE)
+    regr = linear_model.LinearRegression().fit(
+        random_state.random_sample((100, len(regr_utils.FEATURES))),
+        random_state.random_sample(100))
+    size = landsat_features_ds.sizes['x']
+    dem_arr = random_state.uniform(370, 930, (size, size))
+    T_pred_arr = benchmark(make_tair_regr_maps.predict_T, regr,
+                           landsat_features_ds, dem_arr)
+    assert T_pred_arr.shape == (NUM_DATES, size, size)
+
+
+@pytest.mark.benchmark(group='dump_ref_et_rasters')
+def test_dump_ref_et_rasters(benchmark, ref_et_filepath, tmp_path):
+    # the InVEST stack might not be installed
+    invest_utils = pytest.importorskip('lausanne_heat_islands.invest.utils')
+    ref_et_raster_filepath_dict = benchmark(invest_utils.dump_ref_et_rasters,
+                                            ref_et_filepath, str(tmp_path))
+    assert len(ref_et_raster_filepath_dict) == NUM_DATES
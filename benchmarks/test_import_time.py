@@ -0,0 +1,77 @@
+import subprocess
+import sys
+import time
+from os import path
+
+import pytest
+
+# cold startup (fresh interpreter, `--help`) checks of the `make_*` commands.
+# Startup times depend on the machine (and its load), so rather than comparing
+# them with a reference, the checks fail if a command imports any of the heavy
+# modules that are not needed to start it. The startup times are still
+# recorded (as the `startup_time` property of each test, e.g., in the report
+# of `pytest --junitxml`) for information
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+CODE_DIR = path.join(ROOT_DIR, 'lausanne_heat_islands')
+
+CLI_FILEPATHS = [
+    'make_biophysical_table_shade.py',
+    'make_station_tair_df.py',
+    'regression/make_landsat_features.py',
+    'regression/make_regression_df.py',
+    'regression/make_regressor.py',
+    'regression/make_tair_regr_maps.py',
+    'invest/make_ref_et.py',
+    'invest/make_calibrate_ucm.py',
+    'invest/make_tair_ucm_maps.py',
+    'pipeline.py',
+]
+# the plotting stack is only needed in the notebooks, so none of the commands
+# should import it at startup
+PLOT_MODULES = [
+    'seaborn', 'matplotlib.pyplot', 'lausanne_heat_islands.plot_utils'
+]
+# modules that are only imported within the functions that need them
+LAZY_MODULES = PLOT_MODULES + ['sklearn.gaussian_process']
+
+
+def _run_importtime(args):
+    # run python with `args` in a fresh interpreter and return its wall time
+    # (in seconds) and the set of imported modules
+    start = time.perf_counter()
+    stderr = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            check=True,
+                            cwd=ROOT_DIR,
+                            universal_newlines=True).stderr
+    run_time = time.perf_counter() - start
+    # lines of the form "import time: self [us] | cumulative | module"
+    return run_time, {
+        line.split('|')[-1].strip()
+        for line in stderr.splitlines() if line.startswith('import time:')
+    }
+
+
+def test_utils_import():
+    # the core utils must not pull the plotting stack (nor salem, which
+    # imports matplotlib)
+    _, modules = _run_importtime(['-c', 'import lausanne_heat_islands.utils'])
+    for module in PLOT_MODULES + ['matplotlib', 'salem', 'scipy']:
+        assert module not in modules
+
+
+@pytest.mark.parametrize('cli_filepath', CLI_FILEPATHS)
+def test_cli_startup(cli_filepath, record_property):
+    try:
+        startup_time, modules = _run_importtime(
+            [path.join(CODE_DIR, cli_filepath), '--help'])
+    except subprocess.CalledProcessError as e:
+        # some of the commands depend on packages (e.g., the InVEST stack)
+        # that might not be installed
+        if 'ModuleNotFoundError' in e.stderr:
+            pytest.skip(e.stderr.strip().splitlines()[-1])
+        raise
+    record_property('startup_time', startup_time)
+    for module in LAZY_MODULES:
+        assert module not in modules, f"{cli_filepath} imports {module}"
@@ -1,16 +1,197 @@
+import functools
 import json
 import logging
+import os
+import random
 import tempfile
 import warnings
+from concurrent import futures
+from os import path
 
 import click
 import dotenv
 import invest_ucm_calibration as iuc
+import numpy as np
+import pandas as pd
 
-from lausanne_heat_islands import settings
+from lausanne_heat_islands import settings, utils
 from lausanne_heat_islands.invest import utils as invest_utils
 
 
+def get_x0_bounds(x0, x0_spread):
+    # [x0 * (1 - x0_spread), x0 * (1 + x0_spread)] range of each parameter
+    x0 = np.asarray(x0)
+    return x0 * (1 - x0_spread), x0 * (1 + x0_spread)
+
+
+def get_initial_solutions(x0, num_chains, x0_spread, random_state):
+    # draw `num_chains` initial solutions from a Latin hypercube over the
+    # x0 bounds
+    if num_chains == 1:
+        return [list(x0)]
+    return invest_utils.sample_lhs_solutions(*get_x0_bounds(x0, x0_spread),
+                                             num_chains,
+                                             random_state).tolist()
+
+
+def calibrate_chain(calibrator_args,
+                    calibrator_kws,
+                    initial_solution,
+                    seed,
+                    checkpoint_filepath=None,
+                    resume=False,
+                    surrogate_kws=None):
+    # run a calibration chain in its own workspace, by simulated annealing or,
+    # if `surrogate_kws` is provided, with a surrogate model (see
+    # `invest_utils.UCMCalibrator.calibrate_surrogate`). Seed both the
+    # generator used by simanneal (acceptance) and the one used by `move`
+    # (neighbours) and the surrogate. If `resume` is True and there is a
+    # checkpoint, the chain continues from it (including the state of the
+    # random generators)
+    random.seed(seed)
+    np.random.seed(seed)
+    with tempfile.TemporaryDirectory() as workspace_dir:
+        ucm_calibrator = invest_utils.UCMCalibrator(
+            *calibrator_args,
+            workspace_dir=workspace_dir,
+            initial_solution=initial_solution,
+            checkpoint_filepath=checkpoint_filepath,
+            **calibrator_kws)
+        if surrogate_kws is None:
+            solution, cost = ucm_calibrator.anneal(resume=resume)
+        else:
+            solution, cost = ucm_calibrator.calibrate_surrogate(
+                resume=resume, **surrogate_kws)
+
+    return solution, cost, ucm_calibrator.get_history_df()
+
+
+def calibrate_ucm(agglom_lulc_filepath,
+                  biophysical_table_filepath,
+                  ref_et_filepath,
+                  station_locations_filepath,
+                  station_tair_filepath,
+                  x0,
+                  metric='R2',
+                  stepsize=0.3,
+                  strategy='anneal',
+                  num_initial=10,
+                  num_evaluations=50,
+                  ei_tol=None,
+                  ref_et_cache_dir=None,
+                  num_chains=1,
+                  x0_spread=0.5,
+                  n_jobs=1,
+                  seed=None,
+                  evaluation_cache_filepath=None,
+                  evaluation_cache_tolerance=None,
+                  checkpoint_dir=None,
+                  checkpoint_every=1,
+                  resume=False,
+                  precompute=False):
+    # calibrate the model parameters starting from the solution `x0` (in the
+    # order of `iuc.settings.DEFAULT_UCM_PARAMS`) and return the best
+    # parameters (as a dict), their cost and a data frame with the traces of
+    # all the chains
+    logger = logging.getLogger(__name__)
+
+    # get the ref et rasters (from the persistent cache)
+    ref_et_raster_filepath_dict = invest_utils.get_ref_et_raster_filepath_dict(
+        ref_et_filepath, cache_dir=ref_et_cache_dir)
+
+    # prepare the initial solutions: the x0 values for a single chain,
+    # otherwise a Latin hypercube around them
+    random_state = np.random.RandomState(seed)
+    initial_solutions = get_initial_solutions(x0, num_chains, x0_spread,
+                                              random_state)
+    if seed is None:
+        chain_seeds = [None] * num_chains
+    else:
+        chain_seeds = random_state.randint(2**31, size=num_chains).tolist()
+
+    # the surrogate-based calibration explores the box of the x0 bounds
+    if strategy == 'surrogate':
+        lower, upper = get_x0_bounds(x0, x0_spread)
+        surrogate_kws = dict(lower=lower,
+                             upper=upper,
+                             num_initial=num_initial,
+                             num_evaluations=num_evaluations,
+                             ei_tol=ei_tol)
+    else:
+        surrogate_kws = None
+
+    # each chain gets its own workspace (see `calibrate_chain`), yet all share
+    # the evaluation cache (if provided) so that model runs of previous
+    # calibrations (or other chains) are reused. When running chains
+    # concurrently, split the CPUs among them so that the per-date simulations
+    # of each chain do not oversubscribe the machine
+    if n_jobs == 1:
+        num_workers = None
+    else:
+        num_workers = max(1, os.cpu_count() // n_jobs)
+    _calibrate_chain = functools.partial(
+        calibrate_chain,
+        (agglom_lulc_filepath, biophysical_table_filepath, 'factors',
+         list(ref_et_raster_filepath_dict.values())),
+        dict(station_t_filepath=station_tair_filepath,
+             station_locations_filepath=station_locations_filepath,
+             metric=metric,
+             stepsize=stepsize,
+             num_workers=num_workers,
+             evaluation_cache_filepath=evaluation_cache_filepath,
+             evaluation_cache_tolerance=evaluation_cache_tolerance,
+             checkpoint_every=checkpoint_every,
+             precompute=precompute),
+        resume=resume,
+        surrogate_kws=surrogate_kws)
+    # each chain dumps its checkpoints to its own file
+    if checkpoint_dir is None:
+        checkpoint_filepaths = [None] * num_chains
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_filepaths = [
+            path.join(checkpoint_dir, f'chain-{chain}.pkl')
+            for chain in range(num_chains)
+        ]
+
+    # make it happen
+    if n_jobs == 1:
+        chain_results = map(_calibrate_chain, initial_solutions, chain_seeds,
+                            checkpoint_filepaths)
+    else:
+        with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chain_results = list(
+                executor.map(_calibrate_chain, initial_solutions,
+                             chain_seeds, checkpoint_filepaths))
+    solution, cost = None, np.inf
+    trace_dfs = []
+    for chain, (chain_solution, chain_cost,
+                chain_trace_df) in enumerate(chain_results):
+        logger.info("chain %d: cost=%f with %s", chain, chain_cost,
+                    chain_solution)
+        if chain_cost < cost:
+            solution, cost = chain_solution, chain_cost
+        trace_dfs.append(chain_trace_df)
+
+    model_params = {
+        param_key: param_value
+        for param_key, param_value in zip(iuc.settings.DEFAULT_UCM_PARAMS,
+                                          solution)
+    }
+    trace_df = pd.concat(trace_dfs,
+                         keys=range(num_chains),
+                         names=['chain', 'evaluation'])
+    return model_params, cost, trace_df
+
+
+def _get_dst_filepaths(kwargs):
+    # the calibrated parameters and, if requested, the traces
+    dst_filepaths = [kwargs['dst_filepath']]
+    if kwargs['traces_filepath'] is not None:
+        dst_filepaths.append(kwargs['traces_filepath'])
+    return dst_filepaths
+
+
 @click.command()
 @click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
 @click.argument('biophysical_table_filepath', type=click.Path(exists=True))
@@ -29,10 +210,33 @@ from lausanne_heat_islands.invest import utils as invest_utils
 @click.option('--x0-w-eti', type=float, default=0.2)
 @click.option('--metric', default='R2')
 @click.option('--stepsize', type=float, default=0.3)
+@click.option('--strategy',
+              type=click.Choice(['anneal', 'surrogate']),
+              default='anneal')
+@click.option('--num-initial', type=int, default=10)
+@click.option('--num-evaluations', type=int, default=50)
+@click.option('--ei-tol', type=float)
+@click.option('--ref-et-cache-dir', type=click.Path())
+@click.option('--num-chains', type=int, default=1)
+@click.option('--x0-spread', type=float, default=0.5)
+@click.option('--n-jobs', type=int, default=1)
+@click.option('--seed', type=int)
+@click.option('--traces-filepath', type=click.Path())
+@click.option('--evaluation-cache-filepath', type=click.Path())
+@click.option('--evaluation-cache-tolerance', type=float)
+@click.option('--checkpoint-dir', type=click.Path())
+@click.option('--checkpoint-every', type=int, default=1)
+@click.option('--resume', is_flag=True)
+@click.option('--precompute', is_flag=True)
+@utils.stage_cache(get_dst_filepaths=_get_dst_filepaths)
 def main(agglom_lulc_filepath, biophysical_table_filepath, ref_et_filepath,
          station_locations_filepath, station_tair_filepath, dst_filepath,
          x0_tair_avg_radius, x0_green_area_cooling_dist, x0_w_shade,
-         x0_w_albedo, x0_w_eti, metric, stepsize):
+         x0_w_albedo, x0_w_eti, metric, stepsize, strategy, num_initial,
+         num_evaluations, ei_tol, ref_et_cache_dir,
+         num_chains, x0_spread, n_jobs, seed, traces_filepath,
+         evaluation_cache_filepath, evaluation_cache_tolerance, checkpoint_dir,
+         checkpoint_every, resume, precompute):
     logger = logging.getLogger(__name__)
     # disable InVEST's logging
     for module in ('natcap.invest.urban_cooling_model', 'natcap.invest.utils',
@@ -41,52 +245,53 @@ def main(agglom_lulc_filepath, biophysical_table_filepath, ref_et_filepath,
     # ignore all warnings
     warnings.filterwarnings('ignore')
 
-    # tmp_dir = tempfile.mkdtemp()
-    with tempfile.TemporaryDirectory() as workspace_dir:
-        # dump ref et rasters
-        ref_et_raster_filepath_dict = invest_utils.dump_ref_et_rasters(
-            ref_et_filepath, workspace_dir)
-
-        # prepare initial solution
-        # model_params = {
-        #     't_air_average_radius': x0_tair_avg_radius,
-        #     'green_area_cooling_distance': x0_green_area_cooling_dist,
-        #     'cc_weight_shade': x0_w_shade,
-        #     'cc_weight_albedo': x0_w_albedo,
-        #     'cc_weight_eti': x0_w_eti
-        # }
-        initial_solution = [
-            x0_tair_avg_radius, x0_green_area_cooling_dist, x0_w_shade,
-            x0_w_albedo, x0_w_eti
-        ]
+    if resume and checkpoint_dir is None:
+        raise click.UsageError("--resume requires --checkpoint-dir")
 
-        # client = distributed.Client('tcp://165.22.198.117:8786')
-        ucm_calibrator = iuc.UCMCalibrator(
-            agglom_lulc_filepath,
-            biophysical_table_filepath,
-            'factors',
-            list(ref_et_raster_filepath_dict.values()),
-            station_t_filepath=station_tair_filepath,
-            station_locations_filepath=station_locations_filepath,
-            workspace_dir=workspace_dir,
-            # model_params=model_params,
-            initial_solution=initial_solution,
-            metric=metric,
-            stepsize=stepsize)
+    # model_params = {
+    #     't_air_average_radius': x0_tair_avg_radius,
+    #     'green_area_cooling_distance': x0_green_area_cooling_dist,
+    #     'cc_weight_shade': x0_w_shade,
+    #     'cc_weight_albedo': x0_w_albedo,
+    #     'cc_weight_eti': x0_w_eti
+    # }
+    x0 = [
+        x0_tair_avg_radius, x0_green_area_cooling_dist, x0_w_shade,
+        x0_w_albedo, x0_w_eti
+    ]
+    model_params, cost, trace_df = calibrate_ucm(
+        agglom_lulc_filepath,
+        biophysical_table_filepath,
+        ref_et_filepath,
+        station_locations_filepath,
+        station_tair_filepath,
+        x0,
+        metric=metric,
+        stepsize=stepsize,
+        strategy=strategy,
+        num_initial=num_initial,
+        num_evaluations=num_evaluations,
+        ei_tol=ei_tol,
+        ref_et_cache_dir=ref_et_cache_dir,
+        num_chains=num_chains,
+        x0_spread=x0_spread,
+        n_jobs=n_jobs,
+        seed=seed,
+        evaluation_cache_filepath=evaluation_cache_filepath,
+        evaluation_cache_tolerance=evaluation_cache_tolerance,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_every=checkpoint_every,
+        resume=resume,
+        precompute=precompute)
 
-        # make it happen
-        solution, cost = ucm_calibrator.anneal()
-    # # delete the tmp dir
-    # shutil.rmtree(tmp_dir)
+    # dump the per-chain traces
+    if traces_filepath is not None:
+        trace_df.to_csv(traces_filepath)
+        logger.info("dumped calibration traces to %s", traces_filepath)
 
     # dump the best result
     with open(dst_filepath, 'w') as dst:
-        json.dump(
-            {
-                param_key: param_value
-                for param_key, param_value in zip(
-                    iuc.settings.DEFAULT_UCM_PARAMS, solution)
-            }, dst)
+        json.dump(model_params, dst)
     logger.info("dumped calibrated parameters (R^2=%f) to %s", 1 - cost,
                 dst_filepath)
 
@@ -8,25 +8,21 @@ import pandas as pd
 import salem
 import swiss_uhi_utils as suhi
 
-from lausanne_heat_islands import settings
+from lausanne_heat_islands import settings, utils
 
 # 46.519833 degrees in radians
 LAUSANNE_LAT = 0.811924
 
 
-@click.command()
-@click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
-@click.argument('agglom_extent_filepath', type=click.Path(exists=True))
-@click.argument('station_tair_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-@click.option('--buffer-dist', type=float, default=2000)
-def main(agglom_lulc_filepath, agglom_extent_filepath, station_tair_filepath,
-         dst_filepath, buffer_dist):
-    logger = logging.getLogger(__name__)
+def get_ref_et_da(agglom_lulc_filepath,
+                  agglom_extent_gdf,
+                  station_tair_df,
+                  buffer_dist=2000):
+    # get the reference evapotranspiration data array of the dates of
+    # `station_tair_df`, aligned to the LULC raster
 
     # get the reference information: agglomeration extent (geom), raster
     # metadata (data array)
-    agglom_extent_gdf = gpd.read_file(agglom_extent_filepath)
     crs = agglom_extent_gdf.crs
     ref_geom = agglom_extent_gdf.loc[0]['geometry'].buffer(buffer_dist)
     # lake_geom = agglom_extent_gdf.loc[1]['geometry']
@@ -35,9 +31,8 @@ def main(agglom_lulc_filepath, agglom_extent_filepath, station_tair_filepath,
 
     # preprocess air temperature station measurements data frame (here we just
     # need the dates)
-    # station_tair_df = pd.read_csv(station_tair_filepath, index_col=0)
-    # station_tair_df.index = pd.to_datetime(station_tair_df.index)
-    dates_ser = pd.to_datetime(pd.read_csv(station_tair_filepath).iloc[:, 0])
+    dates_ser = pd.Series(pd.to_datetime(station_tair_df.index),
+                          name=station_tair_df.index.name)
     # this is needed to use DigitalOcean spaces
     suhi.settings.METEOSWISS_S3_CLIENT_KWARGS = {
         'endpoint_url': environ.get('S3_ENDPOINT_URL')
@@ -46,9 +41,27 @@ def main(agglom_lulc_filepath, agglom_extent_filepath, station_tair_filepath,
     ref_eto_da = suhi.get_ref_et_da(dates_ser, ref_geom, LAUSANNE_LAT, crs)
 
     # align it to the reference raster (i.e., LULC)
-    ref_eto_da = suhi.align_ds(ref_eto_da, ref_da)
-    # dump it
-    ref_eto_da.to_netcdf(dst_filepath)
+    return suhi.align_ds(ref_eto_da, ref_da)
+
+
+@click.command()
+@click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
+@click.argument('agglom_extent_filepath', type=click.Path(exists=True))
+@click.argument('station_tair_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--buffer-dist', type=float, default=2000)
+@utils.stage_cache()
+def main(agglom_lulc_filepath, agglom_extent_filepath, station_tair_filepath,
+         dst_filepath, buffer_dist):
+    logger = logging.getLogger(__name__)
+
+    ref_eto_da = get_ref_et_da(agglom_lulc_filepath,
+                               gpd.read_file(agglom_extent_filepath),
+                               pd.read_csv(station_tair_filepath,
+                                           index_col=0),
+                               buffer_dist=buffer_dist)
+    # dump it (the rasters are read by dates, so use a tile layout)
+    utils.dump_dataset(ref_eto_da, dst_filepath)
     logger.info("dumped reference evapotranspiration data-array to %s",
                 dst_filepath)
 
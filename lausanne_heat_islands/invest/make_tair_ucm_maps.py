@@ -1,15 +1,78 @@
 import json
 import logging
+import tempfile
 import warnings
 
 import click
 import geopandas as gpd
-import swiss_uhi_utils as suhi
+import rasterio as rio
 
-from lausanne_heat_islands import settings
+from lausanne_heat_islands import settings, utils
 from lausanne_heat_islands.invest import utils as invest_utils
 
 
+def get_tair_ucm_maps(model_params,
+                      agglom_extent_gdf,
+                      agglom_lulc_filepath,
+                      biophysical_table_filepath,
+                      ref_et_filepath,
+                      station_tair_filepath,
+                      station_locations_filepath,
+                      dst_res,
+                      ref_et_cache_dir=None,
+                      n_jobs=None,
+                      roi_mask_cache_dir=None):
+    # simulate the air temperature maps with the calibrated parameters
+    # `model_params`, and return a dict mapping each target resolution of
+    # `dst_res` to its data array. The model is simulated only once (at the
+    # LULC resolution), and then aggregated to each of the target
+    # resolutions, which must thus be multiples of the LULC resolution (see
+    # `main`)
+
+    # get the agglomeration extent
+    crs = agglom_extent_gdf.crs
+    ref_geom = agglom_extent_gdf.loc[0]['geometry']
+
+    # 1. Predict an air temperature data array (the dates are simulated in
+    #    `n_jobs` processes, each in its own workspace)
+    with tempfile.TemporaryDirectory() as workspace_dir:
+        ucm_wrapper = invest_utils.UCMWrapper(
+            agglom_lulc_filepath,
+            biophysical_table_filepath,
+            ref_et_filepath,
+            station_tair_filepath,
+            station_locations_filepath,
+            extra_ucm_args=model_params,
+            ref_et_cache_dir=ref_et_cache_dir,
+            n_jobs=n_jobs,
+            workspace_dir=workspace_dir)
+        T_ucm_da = ucm_wrapper.predict_t_da()
+
+    # 2. Aggregate the predicted temperature data array to each target
+    #    resolution by block averaging onto the reference grid (data array)
+    #    obtained from the ref geometry (i.e., the same grid for any
+    #    combination of target resolutions), and set the pixels outside the
+    #    valid data region to nan (the agglomeration mask of each grid is only
+    #    rasterized once)
+    return {
+        _dst_res: utils.roi(utils.block_average(
+            T_ucm_da,
+            _dst_res,
+            ref_obj=utils.get_ref_da(ref_geom, _dst_res, dst_crs=crs)),
+                            ref_geom,
+                            crs,
+                            cache_dir=roi_mask_cache_dir)
+        for _dst_res in dst_res
+    }
+
+
+def _get_dst_filepaths(kwargs):
+    # one output file for each target resolution
+    return list(
+        utils.get_res_filepaths(kwargs['dst_filepath'],
+                                kwargs['dst_res']).values())
+
+
 @click.command()
 @click.argument('calibrated_params_filepath', type=click.Path(exists=True))
 @click.argument('agglom_extent_filepath', type=click.Path(exists=True))
@@ -19,11 +82,15 @@ from lausanne_heat_islands.invest import utils as invest_utils
 @click.argument('station_tair_filepath', type=click.Path(exists=True))
 @click.argument('station_locations_filepath', type=click.Path(exists=True))
 @click.argument('dst_filepath', type=click.Path())
-@click.option('--dst-res', type=int, default=200)
+@click.option('--dst-res', type=int, multiple=True, default=[200])
+@click.option('--ref-et-cache-dir', type=click.Path())
+@click.option('--n-jobs', type=int)
+@click.option('--roi-mask-cache-dir', type=click.Path())
+@utils.stage_cache(get_dst_filepaths=_get_dst_filepaths)
 def main(calibrated_params_filepath, agglom_extent_filepath,
          agglom_lulc_filepath, biophysical_table_filepath, ref_et_filepath,
          station_tair_filepath, station_locations_filepath, dst_filepath,
-         dst_res):
+         dst_res, ref_et_cache_dir, n_jobs, roi_mask_cache_dir):
     logger = logging.getLogger(__name__)
     # disable InVEST's logging
     for module in ('natcap.invest.urban_cooling_model', 'natcap.invest.utils',
@@ -35,33 +102,42 @@ def main(calibrated_params_filepath, agglom_extent_filepath,
     # Compute an air temperature array from the calibrated InVEST urban
     # cooling model
     # 0. Preprocess the inputs
-    # get the agglomeration extent
-    agglom_extent_gdf = gpd.read_file(agglom_extent_filepath)
-    crs = agglom_extent_gdf.crs
-    ref_geom = agglom_extent_gdf.loc[0]['geometry']
+    # the model is simulated only once (at the LULC resolution), and then
+    # aggregated to each of the target resolutions, which must thus be
+    # multiples of the LULC resolution
+    with rio.open(agglom_lulc_filepath) as src:
+        lulc_res = min(abs(res) for res in src.res)
+    for _dst_res in dst_res:
+        try:
+            utils.get_block_factor(lulc_res, _dst_res)
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint='--dst-res')
 
     with open(calibrated_params_filepath) as src:
         model_params = json.load(src)
 
-    # 1. Predict an air temperature data array
-    ucm_wrapper = invest_utils.UCMWrapper(agglom_lulc_filepath,
-                                          biophysical_table_filepath,
-                                          ref_et_filepath,
-                                          station_tair_filepath,
-                                          station_locations_filepath,
-                                          extra_ucm_args=model_params)
-    T_ucm_da = ucm_wrapper.predict_t_da()
-
-    # 2. Use the ref geometry to obtain the reference grid (data array) with
-    #    the target resolution and align the predicted temperature data array
-    #    to it
-    ref_da = suhi.get_ref_da(ref_geom, dst_res, fill=0, crs=crs)
-    T_ucm_da = ref_da.salem.transform(T_ucm_da, interp='linear')
-
-    # 3. Crop the data array to the valid data region and dump it to a file
-    T_ucm_da.salem.roi(geometry=ref_geom, crs=crs).to_netcdf(dst_filepath)
-    logger.info("dumped simulated air temperature data array to %s",
-                dst_filepath)
+    T_ucm_da_dict = get_tair_ucm_maps(model_params,
+                                      gpd.read_file(agglom_extent_filepath),
+                                      agglom_lulc_filepath,
+                                      biophysical_table_filepath,
+                                      ref_et_filepath,
+                                      station_tair_filepath,
+                                      station_locations_filepath,
+                                      dst_res,
+                                      ref_et_cache_dir=ref_et_cache_dir,
+                                      n_jobs=n_jobs,
+                                      roi_mask_cache_dir=roi_mask_cache_dir)
+
+    # dump the data array of each target resolution to a file (use a time
+    # layout since the maps are analyzed at the pixel level)
+    for _dst_res, _dst_filepath in utils.get_res_filepaths(
+            dst_filepath, dst_res).items():
+        utils.dump_dataset(T_ucm_da_dict[_dst_res],
+                           _dst_filepath,
+                           chunk_layout='time')
+        logger.info(
+            "dumped simulated air temperature data array at %d m to %s",
+            _dst_res, _dst_filepath)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,16 @@
-import tempfile
-from os import path
+import fcntl
+import functools
+import glob
+import hashlib
+import json
+import math
+import os
+import pickle
+import random
+import sqlite3
+import time
+from concurrent import futures
+from os import environ, path
 
 import invest_ucm_calibration as iuc
 import numpy as np
@@ -7,7 +18,37 @@ import pandas as pd
 import rasterio as rio
 import salem  # noqa: F401
 import xarray as xr
-from rasterio import transform
+from rasterio import enums, transform, warp
+from scipy import signal
+
+from lausanne_heat_islands import utils
+
+# persistent cache of the reference evapotranspiration rasters (shared by the
+# calibration, the map generation and the notebooks)
+REF_ET_CACHE_DIR = environ.get(
+    'REF_ET_CACHE_DIR',
+    path.join(path.expanduser('~'), '.cache', 'lausanne-heat-islands',
+              'ref-et'))
+# maximum size (in bytes) of the cache
+REF_ET_CACHE_MAX_SIZE = 2**30
+# name of the lock file of each reference evapotranspiration file's directory
+# within the cache (see `_lock_ref_et_cache_dir`)
+REF_ET_CACHE_LOCK_FILENAME = '.lock'
+# relative tolerance under which two parameter values are considered equal
+# when looking up the evaluation cache
+EVALUATION_CACHE_TOLERANCE = 1e-3
+# number of random candidates over which the expected improvement is maximized
+# at each step of the surrogate-based calibration
+SURROGATE_NUM_CANDIDATES = 2000
+# the surrogate-based calibration stops when the maximum expected improvement
+# falls below this value
+SURROGATE_EI_TOL = 1e-4
+# maximum number of Latin hypercubes drawn to obtain the requested number of
+# solutions within the box of the surrogate-based calibration
+SURROGATE_MAX_DRAWS = 100
+# number of (green area cooling distance) kernels for which the convolved
+# green area rasters are kept in memory
+GREEN_AREA_CACHE_SIZE = 16
 
 
 def _get_ref_eto_filepath(date, dst_dir):
@@ -15,8 +56,9 @@ def _get_ref_eto_filepath(date, dst_dir):
         dst_dir, f'ref_eto_{pd.to_datetime(date).strftime("%Y-%m-%d")}.tif')
 
 
-def dump_ref_et_rasters(ref_et_filepath, dst_dir):
-    ref_et_da = xr.open_dataarray(ref_et_filepath)
+def dump_ref_et_rasters(ref_et_filepath, dst_dir, overwrite=True):
+    # lazily open the data array so that the rasters are read date by date
+    ref_et_da = utils.open_dataarray(ref_et_filepath)
 
     # prepare metadata to dump the potential evapotranspiration rasters
     ref_et_da.name = 'ref_et'
@@ -36,22 +78,126 @@ def dump_ref_et_rasters(ref_et_filepath, dst_dir):
                 crs=ref_et_da.attrs['pyproj_srs'])
 
     ref_et_raster_filepath_dict = {}
-    for date, ref_et_day_da in ref_et_da.groupby('time'):
+    for date in ref_et_da['time'].values:
         ref_et_raster_filepath = _get_ref_eto_filepath(date, dst_dir)
-        with rio.open(ref_et_raster_filepath, 'w', **meta) as dst:
-            dst.write(ref_et_day_da.values, 1)
+        if overwrite or not path.exists(ref_et_raster_filepath):
+            # write to a temporary file first so that concurrent processes
+            # never see a partially written raster
+            tmp_filepath = f'{ref_et_raster_filepath}.{os.getpid()}.tmp'
+            with rio.open(tmp_filepath, 'w', **meta) as dst:
+                dst.write(ref_et_da.sel(time=date).values, 1)
+            os.replace(tmp_filepath, ref_et_raster_filepath)
         ref_et_raster_filepath_dict[date] = ref_et_raster_filepath
 
     return ref_et_raster_filepath_dict
 
 
+# open lock files of the cache directories used by this process (kept open,
+# hence locked, until the process exits)
+_ref_et_cache_lock_dict = {}
+
+
+def _lock_ref_et_cache_dir(ref_et_cache_dir):
+    # hold a shared lock on the directory of a reference evapotranspiration
+    # file for the lifetime of the process, so that no other process evicts
+    # its rasters while they are used (the lock is inherited by the forked
+    # worker processes). This blocks while another process is evicting them
+    if ref_et_cache_dir not in _ref_et_cache_lock_dict:
+        lock_file = open(
+            path.join(ref_et_cache_dir, REF_ET_CACHE_LOCK_FILENAME), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        _ref_et_cache_lock_dict[ref_et_cache_dir] = lock_file
+
+
+def _evict_ref_et_cache(cache_dir, max_size, keep_filepaths):
+    # delete the least recently used rasters until the cache size is below
+    # `max_size`, never deleting those of `keep_filepaths` nor those of the
+    # directories that are locked by running processes (including this one,
+    # see `_lock_ref_et_cache_dir`), which are skipped
+    stat_dict = {
+        filepath: os.stat(filepath)
+        for filepath in glob.glob(path.join(cache_dir, '*', '*.tif'))
+    }
+    cache_size = sum(stat.st_size for stat in stat_dict.values())
+    # exclusive locks of the directories whose rasters can be evicted (None
+    # for those that are in use)
+    evict_lock_dict = {}
+    try:
+        for filepath in sorted(
+                stat_dict, key=lambda filepath: stat_dict[filepath].st_mtime):
+            if cache_size <= max_size:
+                break
+            if filepath in keep_filepaths:
+                continue
+            ref_et_cache_dir = path.dirname(filepath)
+            if ref_et_cache_dir not in evict_lock_dict:
+                lock_file = open(
+                    path.join(ref_et_cache_dir, REF_ET_CACHE_LOCK_FILENAME),
+                    'a')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    lock_file = None
+                evict_lock_dict[ref_et_cache_dir] = lock_file
+            if evict_lock_dict[ref_et_cache_dir] is None:
+                continue
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                # evicted by another process in the meantime
+                pass
+            cache_size -= stat_dict[filepath].st_size
+    finally:
+        # closing the lock files releases the locks. Note that the
+        # directories (and their lock files) are kept, since removing a lock
+        # file that another process might be about to lock is not safe
+        for lock_file in evict_lock_dict.values():
+            if lock_file is not None:
+                lock_file.close()
+
+
+def get_ref_et_raster_filepath_dict(ref_et_filepath,
+                                    cache_dir=None,
+                                    max_cache_size=None):
+    # get the per-date reference evapotranspiration rasters from the
+    # persistent cache, dumping only those that are not there yet. The
+    # rasters are keyed by the hash of the `ref_et_filepath` file and the date
+    if cache_dir is None:
+        cache_dir = REF_ET_CACHE_DIR
+    if max_cache_size is None:
+        max_cache_size = REF_ET_CACHE_MAX_SIZE
+
+    ref_et_cache_dir = path.join(cache_dir,
+                                 utils.get_file_hash(ref_et_filepath))
+    os.makedirs(ref_et_cache_dir, exist_ok=True)
+    # lock the rasters (before dumping them) while this process runs
+    _lock_ref_et_cache_dir(ref_et_cache_dir)
+    ref_et_raster_filepath_dict = dump_ref_et_rasters(ref_et_filepath,
+                                                      ref_et_cache_dir,
+                                                      overwrite=False)
+    # mark the rasters as recently used and evict the least recently used
+    ref_et_raster_filepaths = list(ref_et_raster_filepath_dict.values())
+    for ref_et_raster_filepath in ref_et_raster_filepaths:
+        os.utime(ref_et_raster_filepath)
+    _evict_ref_et_cache(cache_dir, max_cache_size, ref_et_raster_filepaths)
+
+    return ref_et_raster_filepath_dict
+
+
 class UCMWrapper(iuc.UCMWrapper):
-    def __init__(self, lulc_raster_filepath, biophysical_table_filepath,
-                 ref_et_filepath, station_tair_filepath,
-                 station_locations_filepath, extra_ucm_args, **kwargs):
-        ref_et_dir = tempfile.mkdtemp()
-        ref_et_raster_filepath_dict = dump_ref_et_rasters(
-            ref_et_filepath, ref_et_dir)
+    def __init__(self,
+                 lulc_raster_filepath,
+                 biophysical_table_filepath,
+                 ref_et_filepath,
+                 station_tair_filepath,
+                 station_locations_filepath,
+                 extra_ucm_args,
+                 ref_et_cache_dir=None,
+                 n_jobs=None,
+                 **kwargs):
+        ref_et_raster_filepath_dict = get_ref_et_raster_filepath_dict(
+            ref_et_filepath, cache_dir=ref_et_cache_dir)
         self.dates = list(ref_et_raster_filepath_dict.keys())
         super(UCMWrapper, self).__init__(
             lulc_raster_filepath,
@@ -62,3 +208,601 @@ class UCMWrapper(iuc.UCMWrapper):
             station_locations_filepath=station_locations_filepath,
             extra_ucm_args=extra_ucm_args,
             **kwargs)
+        # number of processes to simulate the dates. If None, the dask-based
+        # implementation of `iuc.UCMWrapper` (with `num_workers`) is used
+        self.n_jobs = n_jobs
+
+    def predict_t_da(self, ucm_args=None):
+        if self.n_jobs is None:
+            return super(UCMWrapper, self).predict_t_da(ucm_args=ucm_args)
+
+        # each date is simulated in a separate process, in its own workspace
+        # (a subdirectory of `workspace_dir` named after the date index, see
+        # `iuc.UCMWrapper.predict_t_arr`)
+        date_indices = range(len(self.ref_et_raster_filepaths))
+        if self.n_jobs == 1:
+            t_arrs = [self.predict_t_arr(i, ucm_args) for i in date_indices]
+        else:
+            with futures.ProcessPoolExecutor(
+                    max_workers=self.n_jobs) as executor:
+                t_arrs = list(
+                    executor.map(self.predict_t_arr, date_indices,
+                                 [ucm_args] * len(date_indices)))
+
+        if self.dates is None:
+            dates = np.arange(len(self.ref_et_raster_filepaths))
+        else:
+            dates = self.dates
+        t_da = xr.DataArray(t_arrs,
+                            dims=('time', 'y', 'x'),
+                            coords={
+                                'time': dates,
+                                'y': self.grid_y,
+                                'x': self.grid_x
+                            },
+                            name='T',
+                            attrs={'pyproj_srs': self.meta['crs'].to_proj4()})
+        return t_da.where(xr.DataArray(self.data_mask, dims=('y', 'x')))
+
+
+def _get_exponential_kernel(decay_kernel_distance):
+    # normalized exponential decay kernel, as in
+    # `natcap.invest.utils.exponential_decay_kernel_raster`
+    if decay_kernel_distance == 0:
+        return np.ones((1, 1))
+    max_distance = decay_kernel_distance * 5
+    kernel_size = int(np.round(max_distance * 2 + 1))
+    kernel_dists = np.hypot(*(np.indices((kernel_size, kernel_size)) -
+                              max_distance))
+    kernel = np.where(kernel_dists > max_distance, 0,
+                      np.exp(-kernel_dists / decay_kernel_distance))
+    return kernel / kernel.sum()
+
+
+def _get_disk_kernel(max_distance):
+    # flat disk kernel, as in `natcap.invest.urban_cooling_model`
+    kernel_size = int(np.round(max_distance * 2 + 1))
+    kernel_dists = np.hypot(*(np.indices((kernel_size, kernel_size)) -
+                              max_distance))
+    return (kernel_dists < max_distance).astype(np.float64)
+
+
+def _convolve(arr, valid_mask, kernel):
+    # as `pygeoprocessing.convolve_2d` with `ignore_nodata=True`, i.e., the
+    # invalid pixels are not included when averaging the convolution kernel,
+    # and the result is nan where `arr` is invalid
+    kernel_sum = kernel.sum()
+    if kernel_sum == 0:
+        return np.where(valid_mask, 0, np.nan)
+    conv_arr = signal.fftconvolve(np.where(valid_mask, arr, 0), kernel,
+                                  mode='same')
+    mask_conv_arr = signal.fftconvolve(valid_mask.astype(np.float64),
+                                       kernel,
+                                       mode='same')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(valid_mask, conv_arr / mask_conv_arr * kernel_sum,
+                        np.nan)
+
+
+def _convolve_at(arr, valid_mask, kernel, rows, cols):
+    # same as `_convolve` but only for the pixels at `rows` and `cols`, which
+    # is much cheaper than convolving the whole raster
+    half_size = kernel.shape[0] // 2
+    pad_arr = np.pad(np.where(valid_mask, arr, 0), half_size, mode='constant')
+    pad_mask_arr = np.pad(valid_mask.astype(np.float64),
+                          half_size,
+                          mode='constant')
+    values = []
+    for row, col in zip(rows, cols):
+        if not valid_mask[row, col]:
+            values.append(np.nan)
+            continue
+        window = (slice(row, row + kernel.shape[0]),
+                  slice(col, col + kernel.shape[1]))
+        values.append(
+            np.sum(pad_arr[window] * kernel) /
+            np.sum(pad_mask_arr[window] * kernel) * kernel.sum())
+    return np.array(values)
+
+
+class UCMIntermediates:
+    # numpy implementation of the urban cooling model (with the 'factors'
+    # cooling capacity method, as in `natcap.invest.urban_cooling_model`) that
+    # computes the intermediates that do not depend on the calibrated
+    # parameters only once, i.e., the shade/albedo/kc/green area
+    # reclassifications of the LULC and the evapotranspiration index of each
+    # date. The green area convolutions only depend on the (pixel) green area
+    # cooling distance and are thus cached too. If `station_rows` and
+    # `station_cols` are provided, the air temperature is only computed at
+    # the station pixels
+    def __init__(self,
+                 lulc_raster_filepath,
+                 biophysical_table_filepath,
+                 ref_et_raster_filepaths,
+                 t_refs,
+                 uhi_maxs,
+                 station_rows=None,
+                 station_cols=None):
+        with rio.open(lulc_raster_filepath) as src:
+            lulc_arr = src.read(1)
+            lulc_meta = src.meta.copy()
+            # square pixels, as in the urban cooling model
+            self.cell_size = np.min(np.abs(src.res))
+        if lulc_meta['nodata'] is None:
+            self.valid_mask = np.ones(lulc_arr.shape, dtype=bool)
+        else:
+            self.valid_mask = lulc_arr != lulc_meta['nodata']
+
+        # reclassify the LULC according to the biophysical table
+        biophysical_df = pd.read_csv(biophysical_table_filepath).rename(
+            columns=str.lower).set_index('lucode')
+
+        def reclassify(prop):
+            return pd.Series(lulc_arr.ravel()).map(
+                biophysical_df[prop]).values.reshape(lulc_arr.shape).astype(
+                    np.float32)
+
+        self.shade_arr = reclassify('shade')
+        self.albedo_arr = reclassify('albedo')
+        self.green_area_arr = reclassify('green_area')
+        kc_arr = reclassify('kc')
+
+        # evapotranspiration index of each date, with the reference
+        # evapotranspiration resampled to the LULC grid
+        self.eti_arrs = []
+        for ref_et_raster_filepath in ref_et_raster_filepaths:
+            ref_et_arr = np.full(lulc_arr.shape, np.nan, dtype=np.float32)
+            with rio.open(ref_et_raster_filepath) as src:
+                warp.reproject(src.read(1).astype(np.float32),
+                               ref_et_arr,
+                               src_transform=src.transform,
+                               src_crs=src.crs,
+                               src_nodata=src.nodata,
+                               dst_transform=lulc_meta['transform'],
+                               dst_crs=lulc_meta['crs'],
+                               dst_nodata=np.nan,
+                               resampling=enums.Resampling.cubic_spline)
+            ref_et_max = np.round(np.nanmax(ref_et_arr), decimals=9)
+            self.eti_arrs.append(kc_arr * ref_et_arr / ref_et_max)
+
+        self.t_refs = np.asarray(t_refs)
+        self.uhi_maxs = np.asarray(uhi_maxs)
+        self.station_rows = station_rows
+        self.station_cols = station_cols
+
+        # convert 2 hectares to number of pixels
+        self.green_area_threshold = 2e4 / self.cell_size**2
+        self._get_green_area_arrs = functools.lru_cache(
+            maxsize=GREEN_AREA_CACHE_SIZE)(self._compute_green_area_arrs)
+
+    def _compute_green_area_arrs(self, green_area_decay_kernel_distance):
+        # cooling capacity of parks and green area within the search radius
+        valid_mask = self.valid_mask & ~np.isnan(self.green_area_arr)
+        cc_park_arr = _convolve(
+            self.green_area_arr, valid_mask,
+            _get_exponential_kernel(green_area_decay_kernel_distance))
+        green_area_sum_arr = _convolve(
+            self.green_area_arr, valid_mask,
+            _get_disk_kernel(green_area_decay_kernel_distance))
+        return cc_park_arr, green_area_sum_arr
+
+    def predict_t_arr(self, i, ucm_params):
+        # air temperature of the `i`-th date (at the station pixels if they
+        # have been provided, otherwise the whole raster)
+        cc_weight_sum = ucm_params['cc_weight_shade'] + ucm_params[
+            'cc_weight_albedo'] + ucm_params['cc_weight_eti']
+        cc_arr = (ucm_params['cc_weight_shade'] * self.shade_arr +
+                  ucm_params['cc_weight_albedo'] * self.albedo_arr +
+                  ucm_params['cc_weight_eti'] *
+                  self.eti_arrs[i]) / cc_weight_sum
+        cc_park_arr, green_area_sum_arr = self._get_green_area_arrs(
+            int(np.round(ucm_params['green_area_cooling_distance'] /
+                         self.cell_size)))
+
+        # heat mitigation index
+        with np.errstate(invalid='ignore'):
+            cc_mask = ((cc_arr >= cc_park_arr) | np.isnan(cc_park_arr) |
+                       (green_area_sum_arr < self.green_area_threshold))
+        hm_arr = np.where(cc_mask, cc_arr, cc_park_arr)
+
+        # air temperature
+        t_air_nomix_arr = self.t_refs[i] + (1 - hm_arr) * self.uhi_maxs[i]
+        decay_kernel = _get_exponential_kernel(
+            int(np.round(ucm_params['t_air_average_radius'] /
+                         self.cell_size)))
+        valid_mask = ~np.isnan(t_air_nomix_arr)
+        if self.station_rows is None:
+            return _convolve(t_air_nomix_arr, valid_mask, decay_kernel)
+        return _convolve_at(t_air_nomix_arr, valid_mask, decay_kernel,
+                            self.station_rows, self.station_cols)
+
+    def predict_t(self, ucm_params):
+        # air temperature of all the dates, as in `iuc.UCMWrapper.predict_t`
+        return np.hstack([
+            self.predict_t_arr(i, ucm_params)
+            for i in range(len(self.eti_arrs))
+        ])
+
+
+def sample_lhs_solutions(lower, upper, num_solutions, random_state):
+    # draw `num_solutions` solutions from a Latin hypercube over the box
+    # between `lower` and `upper`, rescaling the three weights (the last three
+    # parameters) so that they add up to one (as in `iuc.UCMCalibrator.move`)
+    lower, upper = np.asarray(lower), np.asarray(upper)
+    # each column is a random permutation of the strata, jittered within them
+    strata_arr = np.argsort(random_state.rand(num_solutions, len(lower)),
+                            axis=0)
+    lhs_arr = (strata_arr +
+               random_state.rand(num_solutions, len(lower))) / num_solutions
+    solution_arr = lower + lhs_arr * (upper - lower)
+    solution_arr[:, 2:] /= solution_arr[:, 2:].sum(axis=1, keepdims=True)
+    return solution_arr
+
+
+def sample_box_solutions(lower, upper, num_solutions, random_state):
+    # draw `num_solutions` solutions as in `sample_lhs_solutions`, but only
+    # keeping those that remain within the box between `lower` and `upper`
+    # once their weights are rescaled (i.e., rejection sampling)
+    lower, upper = np.asarray(lower), np.asarray(upper)
+    if lower[2:].sum() > 1 or upper[2:].sum() < 1:
+        raise ValueError("the box does not contain any solution whose "
+                         "weights add up to one")
+    solution_arrs = []
+    num_sampled = 0
+    for _ in range(SURROGATE_MAX_DRAWS):
+        solution_arr = sample_lhs_solutions(lower, upper, num_solutions,
+                                            random_state)
+        solution_arr = solution_arr[((solution_arr >= lower) &
+                                     (solution_arr <= upper)).all(axis=1)]
+        solution_arrs.append(solution_arr)
+        num_sampled += len(solution_arr)
+        if num_sampled >= num_solutions:
+            return np.concatenate(solution_arrs)[:num_solutions]
+    raise ValueError(
+        f"could not sample {num_solutions} solutions within the box")
+
+
+class UCMEvaluationCache:
+    # persistent (SQLite) cache of the station-level predictions of the urban
+    # cooling model. The evaluations are keyed by a `context` (hash of the
+    # model inputs) and the parameter vector quantized to bins of `tolerance`
+    # relative width, so that (nearly) equal solutions are only simulated once
+    # across calibrations and metrics (the metrics are cheap to compute from
+    # the cached predictions, hence they are not cached)
+    def __init__(self, cache_filepath, context, tolerance=None):
+        if tolerance is None:
+            tolerance = EVALUATION_CACHE_TOLERANCE
+        self.context = context
+        self.tolerance = tolerance
+
+        # several calibration chains might share the cache concurrently
+        self.conn = sqlite3.connect(cache_filepath, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS evaluations '
+                              '(context TEXT, key TEXT, params TEXT, '
+                              'pred BLOB, PRIMARY KEY (context, key))')
+
+    def _get_key(self, params):
+        # logarithmic bins so that the tolerance is relative to each
+        # parameter's magnitude (the parameters are non-negative)
+        log_params = np.log(np.maximum(params, np.finfo(float).tiny))
+        return json.dumps(
+            np.round(log_params / np.log1p(self.tolerance)).astype(
+                int).tolist())
+
+    def get_pred_arr(self, params):
+        row = self.conn.execute(
+            'SELECT pred FROM evaluations WHERE context=? AND key=?',
+            (self.context, self._get_key(params))).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float64)
+
+    def set_pred_arr(self, params, pred_arr):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?)',
+                (self.context, self._get_key(params), json.dumps(
+                    list(params)), np.asarray(pred_arr,
+                                              dtype=np.float64).tobytes()))
+
+
+def get_evaluation_context(ucm_wrapper, engine='invest'):
+    # hash everything that the predictions depend on except for the calibrated
+    # parameters: the implementation of the model, the input rasters/tables,
+    # the observations, and the remaining arguments of the urban cooling model
+    h = hashlib.sha1(engine.encode())
+    for filepath in [
+            ucm_wrapper.base_args['lulc_raster_path'],
+            ucm_wrapper.base_args['biophysical_table_path']
+    ] + list(ucm_wrapper.ref_et_raster_filepaths):
+        h.update(utils.get_file_hash(filepath).encode())
+    for arr in [
+            ucm_wrapper.obs_arr, ucm_wrapper.t_refs, ucm_wrapper.uhi_maxs,
+            getattr(ucm_wrapper, 'station_rows', []),
+            getattr(ucm_wrapper, 'station_cols', [])
+    ]:
+        h.update(np.asarray(arr, dtype=np.float64).tobytes())
+    h.update(
+        json.dumps(
+            {
+                key: value
+                for key, value in ucm_wrapper.base_args.items()
+                if key not in iuc.settings.DEFAULT_UCM_PARAMS and not (
+                    key.endswith('_path') or key.endswith('_dir'))
+            },
+            sort_keys=True,
+            default=str).encode())
+    return h.hexdigest()
+
+
+class UCMCalibrator(iuc.UCMCalibrator):
+    def __init__(self,
+                 *args,
+                 evaluation_cache_filepath=None,
+                 evaluation_cache_tolerance=None,
+                 checkpoint_filepath=None,
+                 checkpoint_every=1,
+                 precompute=False,
+                 **kwargs):
+        super(UCMCalibrator, self).__init__(*args, **kwargs)
+        # evaluated solutions, i.e., the five model parameters followed by the
+        # cost, in the order in which they have been evaluated
+        self.history = []
+        # initial design of the surrogate-based calibration (persisted in the
+        # checkpoints so that it is not drawn again when resuming)
+        self.surrogate_design = None
+
+        # compute the parameter-independent intermediates once so that each
+        # evaluation only runs the parameter-dependent steps of the model
+        if precompute:
+            if self.ucm_wrapper.base_args['cc_method'] != 'factors':
+                raise ValueError(
+                    "precompute is only supported for the 'factors' method")
+            self.ucm_intermediates = UCMIntermediates(
+                self.ucm_wrapper.base_args['lulc_raster_path'],
+                self.ucm_wrapper.base_args['biophysical_table_path'],
+                self.ucm_wrapper.ref_et_raster_filepaths,
+                self.ucm_wrapper.t_refs,
+                self.ucm_wrapper.uhi_maxs,
+                station_rows=getattr(self.ucm_wrapper, 'station_rows', None),
+                station_cols=getattr(self.ucm_wrapper, 'station_cols', None))
+            engine = 'precompute'
+        else:
+            self.ucm_intermediates = None
+            engine = 'invest'
+
+        # persistent cache of model evaluations
+        if evaluation_cache_filepath is None:
+            self.evaluation_cache = None
+        else:
+            self.evaluation_cache = UCMEvaluationCache(
+                evaluation_cache_filepath,
+                get_evaluation_context(self.ucm_wrapper, engine=engine),
+                tolerance=evaluation_cache_tolerance)
+
+        # periodically dump the annealing state so that it can be resumed
+        self.checkpoint_filepath = checkpoint_filepath
+        self.checkpoint_every = checkpoint_every
+
+    def _predict_t(self):
+        if self.ucm_intermediates is None:
+            return self.ucm_wrapper.predict_t(
+                ucm_args=self._ucm_params_dict.copy()).flatten()
+        return self.ucm_intermediates.predict_t(
+            self._ucm_params_dict).flatten()
+
+    def energy(self):
+        if self.evaluation_cache is None:
+            pred_arr = self._predict_t()
+        else:
+            # only run the model if (a nearly equal) solution has not been
+            # evaluated before
+            pred_arr = self.evaluation_cache.get_pred_arr(self.state)
+            if pred_arr is None:
+                pred_arr = self._predict_t()
+                self.evaluation_cache.set_pred_arr(self.state, pred_arr)
+        cost = self.compute_metric(self.ucm_wrapper.obs_arr,
+                                   pred_arr[self.ucm_wrapper.obs_mask])
+        self.history.append(list(self.state) + [cost])
+        return cost
+
+    def get_history_df(self):
+        return pd.DataFrame(self.history,
+                            columns=list(iuc.settings.DEFAULT_UCM_PARAMS) +
+                            ['cost'])
+
+    def dump_checkpoint(self, step, energy):
+        # dump the annealing state after `step`, i.e., the current solution
+        # (and its `energy`), the best solution, the schedule, the state of
+        # the random generators, the evaluation history and the initial
+        # design of the surrogate-based calibration (if any)
+        checkpoint = dict(state=self.state,
+                          energy=energy,
+                          best_state=self.best_state,
+                          best_energy=self.best_energy,
+                          step=step,
+                          steps=self.steps,
+                          Tmax=self.Tmax,
+                          Tmin=self.Tmin,
+                          random_state=random.getstate(),
+                          np_random_state=np.random.get_state(),
+                          history=self.history,
+                          surrogate_design=self.surrogate_design)
+        # write to a temporary file first so that a preemption while dumping
+        # does not corrupt the last checkpoint
+        tmp_filepath = f'{self.checkpoint_filepath}.tmp'
+        with open(tmp_filepath, 'wb') as dst:
+            pickle.dump(checkpoint, dst)
+        os.replace(tmp_filepath, self.checkpoint_filepath)
+
+    def load_checkpoint(self):
+        # restore the annealing state, returning the step and the energy of
+        # the current solution
+        with open(self.checkpoint_filepath, 'rb') as src:
+            checkpoint = pickle.load(src)
+        self.state = checkpoint['state']
+        self.best_state = checkpoint['best_state']
+        self.best_energy = checkpoint['best_energy']
+        self.steps = checkpoint['steps']
+        self.Tmax = checkpoint['Tmax']
+        self.Tmin = checkpoint['Tmin']
+        random.setstate(checkpoint['random_state'])
+        np.random.set_state(checkpoint['np_random_state'])
+        self.history = checkpoint['history']
+        self.surrogate_design = checkpoint.get('surrogate_design')
+        return checkpoint['step'], checkpoint['energy']
+
+    def anneal(self, resume=False):
+        # same procedure as `simanneal.Annealer.anneal` but dumping a
+        # checkpoint every `checkpoint_every` steps, from which the procedure
+        # is continued if `resume` is True
+        if self.checkpoint_filepath is None:
+            return super(UCMCalibrator, self).anneal()
+
+        self.start = time.time()
+        if resume and path.exists(self.checkpoint_filepath):
+            step, E = self.load_checkpoint()
+        else:
+            step = 0
+            E = self.energy()
+            self.best_state = self.copy_state(self.state)
+            self.best_energy = E
+            self.dump_checkpoint(step, E)
+        prev_state = self.copy_state(self.state)
+        prev_energy = E
+
+        # exponential cooling from Tmax to Tmin
+        T_factor = -math.log(self.Tmax / self.Tmin)
+        T = self.Tmax * math.exp(T_factor * step / self.steps)
+        trials, accepts, improves = 0, 0, 0
+        if self.updates > 0:
+            update_wavelength = self.steps / self.updates
+            self.update(step, T, E, None, None)
+
+        # attempt moves to new states
+        while step < self.steps and not self.user_exit:
+            step += 1
+            T = self.Tmax * math.exp(T_factor * step / self.steps)
+            self.move()
+            E = self.energy()
+            dE = E - prev_energy
+            trials += 1
+            if dE > 0.0 and math.exp(-dE / T) < random.random():
+                # restore previous state
+                self.state = self.copy_state(prev_state)
+                E = prev_energy
+            else:
+                # accept new state and compare to best state
+                accepts += 1
+                if dE < 0.0:
+                    improves += 1
+                prev_state = self.copy_state(self.state)
+                prev_energy = E
+                if E < self.best_energy:
+                    self.best_state = self.copy_state(self.state)
+                    self.best_energy = E
+            if self.updates > 1:
+                if (step // update_wavelength) > (
+                    (step - 1) // update_wavelength):
+                    self.update(step, T, E, accepts / trials,
+                                improves / trials)
+                    trials, accepts, improves = 0, 0, 0
+            if step % self.checkpoint_every == 0:
+                self.dump_checkpoint(step, E)
+        self.dump_checkpoint(step, prev_energy)
+
+        self.state = self.copy_state(self.best_state)
+        return self.best_state, self.best_energy
+
+    def calibrate_surrogate(self,
+                            lower,
+                            upper,
+                            num_initial,
+                            num_evaluations,
+                            ei_tol=None,
+                            num_candidates=None,
+                            resume=False):
+        # minimize the cost with a Gaussian process surrogate of the model:
+        # evaluate the current solution and a Latin hypercube of
+        # `num_initial` solutions within the `lower`/`upper` box, then
+        # iteratively evaluate the candidate solution that maximizes the
+        # expected improvement until `num_evaluations` model evaluations or
+        # until the maximum expected improvement falls below `ei_tol`. The
+        # random draws use the global `np.random` generator so that the
+        # checkpoints (dumped after each evaluation) can be resumed
+        # the surrogate stack is only imported when needed so that it does not
+        # slow down the startup of the other commands
+        from scipy import stats
+        from sklearn import gaussian_process
+        from sklearn.gaussian_process import kernels
+
+        if ei_tol is None:
+            ei_tol = SURROGATE_EI_TOL
+        if num_candidates is None:
+            num_candidates = SURROGATE_NUM_CANDIDATES
+        lower, upper = np.array(lower, dtype=float), np.array(upper,
+                                                              dtype=float)
+        if self.exclude_zero_kernel_dist:
+            lower[:2] = np.maximum(lower[:2], self.min_kernel_dist)
+
+        def evaluate(solution):
+            self.state = list(solution)
+            E = self.energy()
+            if self.best_energy is None or E < self.best_energy:
+                self.best_state = self.copy_state(self.state)
+                self.best_energy = E
+            if self.checkpoint_filepath is not None:
+                self.dump_checkpoint(len(self.history), E)
+
+        # initial design: the current solution and a Latin hypercube whose
+        # solutions remain within the box once their weights are rescaled (so
+        # that the surrogate never extrapolates). The design is drawn before
+        # the first evaluation so that it is persisted in all the checkpoints
+        if resume and self.checkpoint_filepath is not None and path.exists(
+                self.checkpoint_filepath):
+            self.load_checkpoint()
+        else:
+            self.surrogate_design = None
+        if self.surrogate_design is None:
+            self.surrogate_design = sample_box_solutions(
+                lower, upper, num_initial, np.random)
+        if not self.history:
+            evaluate(self.state)
+        for solution in self.surrogate_design[len(self.history) - 1:]:
+            evaluate(solution)
+
+        # sequential design. Fit the surrogate on parameters scaled to the
+        # unit box
+        gp = gaussian_process.GaussianProcessRegressor(
+            kernel=kernels.ConstantKernel() *
+            kernels.Matern(length_scale=np.ones(len(lower)), nu=2.5) +
+            kernels.WhiteKernel(),
+            normalize_y=True,
+            n_restarts_optimizer=5,
+            random_state=np.random.randint(2**31))
+        while len(self.history) < num_evaluations:
+            history_arr = np.array(self.history)
+            gp.fit((history_arr[:, :-1] - lower) / (upper - lower),
+                   history_arr[:, -1])
+            candidate_arr = sample_box_solutions(lower, upper, num_candidates,
+                                                 np.random)
+            mu, sigma = gp.predict((candidate_arr - lower) / (upper - lower),
+                                   return_std=True)
+            # expected improvement (for a minimization) over the best
+            # evaluated solution
+            improvement = history_arr[:, -1].min() - mu
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z = improvement / sigma
+                ei_arr = np.where(
+                    sigma > 0,
+                    improvement * stats.norm.cdf(z) +
+                    sigma * stats.norm.pdf(z), 0)
+            i = np.argmax(ei_arr)
+            if ei_arr[i] < ei_tol:
+                break
+            evaluate(candidate_arr[i])
+
+        self.state = self.copy_state(self.best_state)
+        return self.best_state, self.best_energy
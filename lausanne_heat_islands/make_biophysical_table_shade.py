@@ -1,86 +1,170 @@
+import functools
 import logging
+from concurrent import futures
 
 import click
 import numpy as np
 import pandas as pd
 import rasterio as rio
-from rasterio import transform, windows
+from rasterio import enums, warp, windows
 
-from lausanne_heat_islands import settings
+from lausanne_heat_islands import settings, utils
 
+# side length (in LULC pixels) of the square windows processed at once
+TILE_SIZE = 128
 
-@click.command()
-@click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
-@click.argument('tree_canopy_filepath', type=click.Path(exists=True))
-@click.argument('biophysical_table_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-def main(agglom_lulc_filepath, tree_canopy_filepath,
-         biophysical_table_filepath, dst_filepath):
+
+def get_tree_cover_arr(lulc_src, tree_canopy_src, window=None):
+    # compute the proportion of tree cover of each pixel of the LULC `window`
+    # (the whole raster if None) by reading the overlapping tree canopy pixels
+    # at once and block-averaging them into the LULC grid
+    if window is None:
+        window = windows.Window(0, 0, lulc_src.width, lulc_src.height)
+    dst_shape = (int(window.height), int(window.width))
+
+    # read the tree canopy pixels that fall within the LULC window
+    canopy_window = windows.from_bounds(*windows.bounds(
+        window, lulc_src.transform),
+                                        transform=tree_canopy_src.transform)
+    _canopy_window = canopy_window.round_offsets().round_lengths()
+    # ACHTUNG: gdalmerge might have messed with `src.nodata`
+    # TODO: avoid UGLY HARDCODED zero below (inspect gdalmerge or accept extra
+    # click CLI arg for tree nodata value)
+    # use `boundless` so that LULC pixels outside the tree canopy extent are
+    # considered as having no tree cover
+    canopy_arr = tree_canopy_src.read(1,
+                                      window=_canopy_window,
+                                      boundless=True,
+                                      fill_value=0) != 0
+
+    # if the LULC resolution is an integer multiple of the tree canopy
+    # resolution and both grids are aligned, we can just reshape and average
+    y_factor, x_factor = (lulc_res / tree_res for lulc_res, tree_res in zip(
+        lulc_src.res[::-1], tree_canopy_src.res[::-1]))
+    if (y_factor.is_integer() and x_factor.is_integer()
+            and canopy_arr.shape == (dst_shape[0] * int(y_factor),
+                                     dst_shape[1] * int(x_factor))
+            and np.isclose(canopy_window.col_off, _canopy_window.col_off)
+            and np.isclose(canopy_window.row_off, _canopy_window.row_off)):
+        return canopy_arr.reshape(dst_shape[0], int(y_factor), dst_shape[1],
+                                  int(x_factor)).mean(axis=(1, 3),
+                                                      dtype=np.float64)
+
+    # otherwise, let rasterio do an average resampling
+    tree_cover_arr = np.empty(dst_shape, dtype=np.float32)
+    warp.reproject(canopy_arr.astype(np.float32),
+                   tree_cover_arr,
+                   src_transform=windows.transform(_canopy_window,
+                                                   tree_canopy_src.transform),
+                   src_crs=tree_canopy_src.crs,
+                   dst_transform=windows.transform(window, lulc_src.transform),
+                   dst_crs=lulc_src.crs,
+                   resampling=enums.Resampling.average)
+    return tree_cover_arr.astype(np.float64)
+
+
+def get_window_class_stats(agglom_lulc_filepath, tree_canopy_filepath,
+                           window):
+    # compute the sum of tree cover proportions and the pixel count of each
+    # LULC class within `window`. The rasters are opened here (rather than
+    # passing the datasets around) so that this can run in a worker process.
+    with rio.open(agglom_lulc_filepath) as lulc_src, rio.open(
+            tree_canopy_filepath) as tree_canopy_src:
+        lulc_arr = lulc_src.read(1, window=window)
+        tree_cover_arr = get_tree_cover_arr(lulc_src,
+                                            tree_canopy_src,
+                                            window=window)
+        nodata = lulc_src.nodata
+
+    if nodata is not None:
+        cond = lulc_arr != nodata
+        lulc_arr, tree_cover_arr = lulc_arr[cond], tree_cover_arr[cond]
+    # LULC codes are non-negative integers and can thus be used as bins
+    lulc_arr = lulc_arr.astype(np.intp).ravel()
+    return (np.bincount(lulc_arr, weights=tree_cover_arr.ravel()),
+            np.bincount(lulc_arr))
+
+
+def _add_class_stats(acc_arr, arr):
+    # the length of the `bincount` arrays depends on the largest LULC code
+    # found in each window, so pad the accumulator when needed
+    if len(arr) > len(acc_arr):
+        acc_arr = np.pad(acc_arr, (0, len(arr) - len(acc_arr)),
+                         mode='constant')
+    acc_arr[:len(arr)] += arr
+    return acc_arr
+
+
+def get_biophysical_shade_df(agglom_lulc_filepath,
+                             tree_canopy_filepath,
+                             biophysical_df,
+                             tile_size=TILE_SIZE,
+                             n_jobs=1):
+    # add the shade column to the biophysical table `biophysical_df`
     logger = logging.getLogger(__name__)
 
-    # 1. compute the per-pixel tree cover
-    # read the agglomeration extract raster
+    # 1. compute the per-class sum of the per-pixel tree cover and pixel count
+    # walk the LULC raster in (aligned) square windows of `tile_size` pixels
+    # so that memory usage does not depend on the raster size
     with rio.open(agglom_lulc_filepath) as src:
-        lulc_arr = src.read(1)
-        res = src.res
-        nodata = src.nodata
-
-    # TODO: the `get_pixel_tree_cover` approach should be done more efficiently
-    # as a (fully-vectorized) resampling operation
-    # get a list of (x,y) pixel coordinates
-    lulc_flat_arr = lulc_arr.flatten()
-    cond = lulc_flat_arr != nodata
-    ii, jj = np.meshgrid(np.arange(src.shape[0]),
-                         np.arange(src.shape[1]),
-                         indexing='ij')
-    xys = np.array([
-        transform.xy(src.transform, i, j)
-        for i, j in zip(ii.flatten()[cond],
-                        jj.flatten()[cond])
-    ])
-    logger.info("computed flat list of %d (x, y) pixel coordinates of %s",
-                len(xys), agglom_lulc_filepath)
-
-    # get the percentage of tree cover of each pixel
-    # get_pixel_tree_cover(xy, src, x_inc, y_inc)
-    x_inc, y_inc = res[0] / 2, res[1] / 2
-    with rio.open(tree_canopy_filepath) as src:
-
-        def get_pixel_tree_cover(xy):
-            arr = src.read(1,
-                           window=windows.from_bounds(xy[0] - x_inc,
-                                                      xy[1] - y_inc,
-                                                      xy[0] + x_inc,
-                                                      xy[1] + y_inc,
-                                                      transform=src.transform))
-            # ACHTUNG: gdalmerge might have messed with `src.nodata`
-            # TODO: avoid UGLY HARDCODED zero below (inspect gdalmerge or
-            # accept extra click CLI arg for tree nodata value)
-            # return np.sum(arr != src.nodata) / arr.size
-            return np.sum(arr != 0) / arr.size
-
-        tree_cover_flat_arr = np.apply_along_axis(get_pixel_tree_cover, 1, xys)
-    logger.info("extracted per-pixel proportion of tree cover from %s",
-                tree_canopy_filepath)
-
-    # use `nodata` (instead of `zeros_like`) because it allows distinguishing
-    # actual zeros from nodata
-    # tree_cover_arr = np.zeros_like(lulc_arr, dtype=tree_cover_flat_arr.dtype)
-    tree_cover_arr = np.full_like(lulc_arr,
-                                  nodata,
-                                  dtype=tree_cover_flat_arr.dtype)
-    # use `ravel` instead of `flatten` because the former returns a view that
-    # can be modified in-place (while the latter returns a copy)
-    tree_cover_arr.ravel()[cond] = tree_cover_flat_arr
+        height, width = src.shape
+    tile_windows = [
+        windows.Window(col_off, row_off, min(tile_size, width - col_off),
+                       min(tile_size, height - row_off))
+        for row_off in range(0, height, tile_size)
+        for col_off in range(0, width, tile_size)
+    ]
+
+    tree_cover_sum_arr = np.zeros(0)
+    count_arr = np.zeros(0, dtype=np.intp)
+    _get_window_class_stats = functools.partial(get_window_class_stats,
+                                                agglom_lulc_filepath,
+                                                tree_canopy_filepath)
+    if n_jobs == 1:
+        window_stats = map(_get_window_class_stats, tile_windows)
+    else:
+        with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # the per-window stats are small (one entry per LULC code)
+            window_stats = list(
+                executor.map(_get_window_class_stats, tile_windows))
+    for window_tree_cover_sum_arr, window_count_arr in window_stats:
+        tree_cover_sum_arr = _add_class_stats(tree_cover_sum_arr,
+                                              window_tree_cover_sum_arr)
+        count_arr = _add_class_stats(count_arr, window_count_arr)
+    logger.info(
+        "extracted per-pixel proportion of tree cover from %s in %d windows",
+        tree_canopy_filepath, len(tile_windows))
 
     # 2. compute the average shade coefficient for each of its LULC classes
-    shade_dict = {}
-    for class_val in np.unique(lulc_arr[lulc_arr != nodata]):
-        shade_dict[class_val] = tree_cover_arr[lulc_arr == class_val].mean()
+    class_vals = np.flatnonzero(count_arr)
+    shade_dict = dict(
+        zip(class_vals,
+            tree_cover_sum_arr[class_vals] / count_arr[class_vals]))
     # now add the shade coefficient to the biophysical table
-    biophysical_df = pd.read_csv(biophysical_table_filepath)
+    biophysical_df = biophysical_df.copy()
     biophysical_df['shade'] = biophysical_df['lucode'].apply(
         lambda lulc_code: shade_dict.get(lulc_code, 0))
+    return biophysical_df
+
+
+@click.command()
+@click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
+@click.argument('tree_canopy_filepath', type=click.Path(exists=True))
+@click.argument('biophysical_table_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--tile-size', type=int, default=TILE_SIZE)
+@click.option('--n-jobs', type=int, default=1)
+@utils.stage_cache()
+def main(agglom_lulc_filepath, tree_canopy_filepath,
+         biophysical_table_filepath, dst_filepath, tile_size, n_jobs):
+    logger = logging.getLogger(__name__)
+
+    biophysical_df = get_biophysical_shade_df(
+        agglom_lulc_filepath,
+        tree_canopy_filepath,
+        pd.read_csv(biophysical_table_filepath),
+        tile_size=tile_size,
+        n_jobs=n_jobs)
     # dump it
     biophysical_df.to_csv(dst_filepath)
     logger.info("dumped biophysical table with shade coefficients to %s",
@@ -1,5 +1,9 @@
 import datetime
+import functools
+import json
 import logging
+import os
+import shutil
 from os import path
 
 import click
@@ -7,16 +11,156 @@ import pandas as pd
 import swiss_uhi_utils as suhi
 from pylandsat import utils as pylandsat_utils
 
-from lausanne_heat_islands import settings
+from lausanne_heat_islands import settings, utils
 
+# name of the file (ignored by the parquet readers since it starts with an
+# underscore) that records the hash of the raw file from which a source's
+# store has been built
+STORE_SOURCE_FILENAME = '_source.json'
 
-@click.command()
-@click.argument('landsat_tiles_filepath', type=click.Path(exists=True))
-@click.argument('station_data_dir', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-@click.option('--hour', default=21)
-def main(landsat_tiles_filepath, station_data_dir, dst_filepath, hour):
-    logger = logging.getLogger(__name__)
+
+def _read_meteoswiss(filepath, tair_column):
+    # there might be duplicated time stamps, keep the first measurement
+    return suhi.df_from_meteoswiss_zip(
+        filepath, tair_column).reset_index().groupby('time').first()
+
+
+def _read_vaudair(filepath):
+    vaudair_df = pd.read_excel(filepath, index_col=0)
+    vaudair_df = vaudair_df.iloc[3:]
+    vaudair_df.index = pd.to_datetime(vaudair_df.index)
+    return vaudair_df.apply(pd.to_numeric)
+
+
+def _read_agrometeo(filepath):
+    return suhi.df_from_agrometeo(filepath)
+
+
+def _read_wsl(filepath):
+    return suhi.df_from_wsl(filepath, 'WSLLAF')
+
+
+# raw station data files (relative to the station data dir) and the functions
+# to read them into time-indexed data frames, in the order in which the
+# stations appear in the final data frame
+STATION_SOURCES = {
+    'meteoswiss-tre000s0': ('meteoswiss-lausanne-tre000s0.zip',
+                            functools.partial(_read_meteoswiss,
+                                              tair_column='tre000s0')),
+    'meteoswiss-tre200s0': ('meteoswiss-lausanne-tre200s0.zip',
+                            functools.partial(_read_meteoswiss,
+                                              tair_column='tre200s0')),
+    'vaudair': ('VaudAir_EnvoiTemp20180101-20200128_EPFL_20200129.xlsx',
+                _read_vaudair),
+    'agrometeo': ('agrometeo-tre200s0.csv', _read_agrometeo),
+    'wsl': ('WSLLAF.txt', _read_wsl),
+}
+
+
+def ingest_station_source(source, station_data_dir, store_dir):
+    # convert the raw file of `source` into a parquet dataset partitioned by
+    # year, unless the store has already been built from the same raw file.
+    # Returns the path to the source's store.
+    filename, read_df = STATION_SOURCES[source]
+    filepath = path.join(station_data_dir, filename)
+    source_store_dir = path.join(store_dir, source)
+    source_filepath = path.join(source_store_dir, STORE_SOURCE_FILENAME)
+
+    file_hash = utils.get_file_hash(filepath)
+    if path.exists(source_filepath):
+        with open(source_filepath) as src:
+            if json.load(src)['sha1'] == file_hash:
+                return source_store_dir
+
+    # build the store in a temporary directory first and move it into place
+    # once complete, so that an interrupted ingestion never leaves a partial
+    # store (to which further runs would add duplicated part files)
+    tmp_store_dir = f'{source_store_dir}.{os.getpid()}.tmp'
+    if path.exists(tmp_store_dir):
+        shutil.rmtree(tmp_store_dir)
+    df = read_df(filepath)
+    # parquet requires string column names
+    df.columns = df.columns.astype(str)
+    df.assign(year=df.index.year).to_parquet(tmp_store_dir,
+                                             partition_cols=['year'])
+    with open(path.join(tmp_store_dir, STORE_SOURCE_FILENAME), 'w') as dst:
+        json.dump({'filename': filename, 'sha1': file_hash}, dst)
+    # remove the outdated store (or any partial store left by a previous
+    # version of this function, i.e., without `STORE_SOURCE_FILENAME`)
+    if path.exists(source_store_dir):
+        shutil.rmtree(source_store_dir)
+    os.replace(tmp_store_dir, source_store_dir)
+    logging.getLogger(__name__).info("ingested %s into %s", filepath,
+                                     source_store_dir)
+    return source_store_dir
+
+
+def get_station_df(source,
+                   station_data_dir,
+                   datetimes,
+                   store_dir=None,
+                   tolerance=None):
+    # get the measurements of the stations of `source` at `datetimes`. If
+    # `store_dir` is provided, the measurements are read from the source's
+    # store (only the partitions of the years of `datetimes`, widened by
+    # `tolerance` if provided), otherwise the raw file is parsed.
+    if store_dir is None:
+        filename, read_df = STATION_SOURCES[source]
+        df = read_df(path.join(station_data_dir, filename))
+    else:
+        source_store_dir = ingest_station_source(source, station_data_dir,
+                                                 store_dir)
+        datetimes = pd.DatetimeIndex(datetimes)
+        if tolerance is None:
+            years = set(datetimes.year)
+        else:
+            # the nearest measurement of a time stamp close to a new year
+            # might be in the partition of the previous (or next) year
+            years = set(datetimes.year).union((datetimes - tolerance).year,
+                                              (datetimes + tolerance).year)
+        years = sorted(years)
+        df = pd.read_parquet(source_store_dir,
+                             filters=[('year', 'in', years)
+                                      ]).drop(columns='year')
+
+    # extract all the requested time stamps at once. If `tolerance` is
+    # provided, take the nearest measurement within it, otherwise only exact
+    # matches (missing measurements are set to nan)
+    df = df[~df.index.duplicated()].sort_index()
+    if tolerance is None:
+        return df.reindex(datetimes)
+    return df.reindex(datetimes, method='nearest', tolerance=tolerance)
+
+
+def _parse_hours(ctx, param, value):
+    # parse a comma-separated list of hours and/or ranges of hours, e.g.,
+    # "0-23" or "6,12,18-21"
+    if value is None:
+        return None
+    hours = []
+    try:
+        for hour_range in value.split(','):
+            start, _, end = hour_range.partition('-')
+            start, end = int(start), int(end or start)
+            if not 0 <= start <= end <= 23:
+                raise click.BadParameter(
+                    f"{hour_range} is not an hour or a range of hours "
+                    "within 0-23")
+            hours += range(start, end + 1)
+    except ValueError:
+        raise click.BadParameter(
+            "must be a comma-separated list of hours or ranges of hours")
+    return hours
+
+
+def get_station_tair_df(landsat_tiles,
+                        station_data_dir,
+                        hour=21,
+                        hours=None,
+                        tolerance=None,
+                        store_dir=None):
+    # assemble a data frame of the air temperature station measurements at
+    # the dates of the landsat tiles (product ids) `landsat_tiles`
 
     # # read calibration dates
     # calibration_dates = pd.to_datetime(
@@ -30,55 +174,77 @@ def main(landsat_tiles_filepath, station_data_dir, dst_filepath, hour):
     # get landsat dates
     landsat_dates = [
         pylandsat_utils.meta_from_pid(landsat_tile)['acquisition_date']
-        for landsat_tile in pd.read_csv(landsat_tiles_filepath, header=None)[0]
+        for landsat_tile in landsat_tiles
     ]
 
-    # for each date, get the datetime for the hour for which we want to get
-    # the temperature
-    hour_td = datetime.timedelta(hours=hour)
+    # for each date, get the datetimes for the hours for which we want to get
+    # the temperature (if `hours` is provided, all of them are extracted in a
+    # single pass over each source)
+    if hours is None:
+        _hours = [hour]
+    else:
+        _hours = hours
+    date_hour_index = pd.MultiIndex.from_product(
+        [pd.to_datetime(landsat_dates).date, _hours], names=['date', 'hour'])
     landsat_datetimes = [
-        landsat_date + hour_td for landsat_date in landsat_dates
+        landsat_date + datetime.timedelta(hours=_hour)
+        for landsat_date in landsat_dates for _hour in _hours
     ]
+    if tolerance is not None:
+        # the tolerance is provided in minutes
+        tolerance = pd.Timedelta(minutes=tolerance)
 
-    # assemble a data frame of station temperature measurements
-    dfs = []
-
-    # 1. MeteoSwiss
-    for tair_column in ['tre000s0', 'tre200s0']:
-        dfs.append(
-            suhi.df_from_meteoswiss_zip(
-                path.join(station_data_dir,
-                          f'meteoswiss-lausanne-{tair_column}.zip'),
-                tair_column).loc[landsat_datetimes].reset_index().groupby(
-                    'time').first())
-
-    # 2. VaudAir
-    vaudair_df = pd.read_excel(path.join(
-        station_data_dir,
-        'VaudAir_EnvoiTemp20180101-20200128_EPFL_20200129.xlsx'),
-                               index_col=0)
-    vaudair_df = vaudair_df.iloc[3:]
-    vaudair_df.index = pd.to_datetime(vaudair_df.index)
-    for column in vaudair_df.columns:
-        vaudair_df[column] = pd.to_numeric(vaudair_df[column])
+    # assemble a data frame of station temperature measurements: 1. MeteoSwiss
+    # (two sources), 2. VaudAir, 3. Agrometeo and 4. WSL. If `store_dir` is
+    # provided, each raw source is ingested (only once) into a columnar store
+    # so that further runs do not need to parse the raw files again.
+    dfs = [
+        get_station_df(source,
+                       station_data_dir,
+                       landsat_datetimes,
+                       store_dir=store_dir,
+                       tolerance=tolerance) for source in STATION_SOURCES
+    ]
+
+    # assemble the dataframe
+    df = pd.concat(dfs, axis=1)
+    if hours is None:
+        # keep only the dates in the index
+        df.index = pd.Series(df.index).dt.date
+    else:
+        # index the measurements by date and hour
+        df.index = date_hour_index
+    return df
 
-    dfs.append(vaudair_df.loc[landsat_datetimes])
 
-    # 3. Agrometeo
-    dfs.append(
-        suhi.df_from_agrometeo(
-            path.join(station_data_dir,
-                      'agrometeo-tre200s0.csv')).loc[landsat_datetimes])
+@click.command()
+@click.argument('landsat_tiles_filepath', type=click.Path(exists=True))
+@click.argument('station_data_dir', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--hour', type=click.IntRange(0, 23))
+@click.option('--hours', callback=_parse_hours)
+@click.option('--tolerance', type=int)
+@click.option('--store-dir', type=click.Path())
+@utils.stage_cache()
+def main(landsat_tiles_filepath, station_data_dir, dst_filepath, hour, hours,
+         tolerance, store_dir):
+    logger = logging.getLogger(__name__)
 
-    # 4. WSL
-    dfs.append(
-        suhi.df_from_wsl(path.join(station_data_dir, 'WSLLAF.txt'),
-                         'WSLLAF').loc[landsat_datetimes])
+    # extract either a single hour (21 by default) or several hours
+    if hours is not None:
+        if hour is not None:
+            raise click.BadParameter("cannot be used together with --hour",
+                                     param_hint='--hours')
+    elif hour is None:
+        hour = 21
 
-    # assemble the dataframe
-    df = pd.concat(dfs, axis=1)
-    # keep only the dates in the index
-    df.index = pd.Series(df.index).dt.date
+    df = get_station_tair_df(pd.read_csv(landsat_tiles_filepath,
+                                         header=None)[0],
+                             station_data_dir,
+                             hour=hour,
+                             hours=hours,
+                             tolerance=tolerance,
+                             store_dir=store_dir)
     # dump it (need to dump the index in this case)
     df.to_csv(dst_filepath)
     logger.info("dumped air temperature station measurements to %s",
@@ -0,0 +1,359 @@
+import json
+import logging
+import os
+import tempfile
+import warnings
+from concurrent import futures
+from os import path
+
+import click
+import dotenv
+import geopandas as gpd
+import joblib as jl
+import pandas as pd
+
+from lausanne_heat_islands import settings, utils
+
+# STAGES
+# each stage of the pipeline is named after its Makefile target, and maps to
+# the stages that it depends on and to its output file (relative to the root
+# directory), as in the Makefile
+STAGES = {
+    'biophysical_table_shade': (
+        [], 'data/interim/biophysical-table-shade.csv'),
+    'station_measurements': ([], 'data/interim/station-tair.csv'),
+    'landsat_features': ([], 'data/interim/regression/landsat-features.nc'),
+    'regression_df': (['station_measurements', 'landsat_features'],
+                      'data/interim/regression/regression-df.csv'),
+    'regressor': (['regression_df'], 'models/regressor.joblib'),
+    'tair_regr_maps': (
+        ['station_measurements', 'landsat_features', 'regressor'],
+        'data/processed/tair-regr-maps.nc'),
+    'ref_et': (['station_measurements'], 'data/interim/invest/ref-et.nc'),
+    'calibrate_ucm': (
+        ['biophysical_table_shade', 'ref_et', 'station_measurements'],
+        'data/interim/invest/calibrated-params.json'),
+    'tair_ucm_maps': ([
+        'calibrate_ucm', 'biophysical_table_shade', 'ref_et',
+        'station_measurements'
+    ], 'data/processed/tair-ucm-maps.nc'),
+}
+# the InVEST stages read these inputs from files, so the outputs of these
+# stages are dumped (to a temporary directory unless they are requested)
+# when any of the stages below is run
+FILE_STAGES = ['biophysical_table_shade', 'station_measurements', 'ref_et']
+FILE_CONSUMER_STAGES = ['calibrate_ucm', 'tair_ucm_maps']
+
+# raw inputs (relative to the root directory), as in the Makefile
+AGGLOM_EXTENT_SHP = 'data/raw/agglom-extent/agglom-extent.shp'
+AGGLOM_LULC_TIF = 'data/raw/agglom-lulc.tif'
+TREE_CANOPY_TIF = 'data/raw/tree-canopy.tif'
+BIOPHYSICAL_TABLE_CSV = 'data/raw/biophysical-table.csv'
+LANDSAT_TILES_CSV = 'data/raw/landsat-tiles.csv'
+STATION_RAW_DIR = 'data/raw/stations'
+STATION_LOCATIONS_CSV = 'data/raw/stations/station-locations.csv'
+STATION_STORE_DIR = 'data/interim/station-store'
+SWISS_DEM_TIF = 'data/interim/swiss-dem.tif'
+
+
+# the modules of each stage are only imported when the stage is run, so that
+# running a branch of the pipeline neither requires nor imports the
+# dependencies of the other (e.g., InVEST for the regression)
+class Pipeline:
+    def __init__(self,
+                 root_dir,
+                 tmp_dir,
+                 dst_res=None,
+                 landsat_cache_dir=None,
+                 force=False):
+        self.root_dir = root_dir
+        self.tmp_dir = tmp_dir
+        if dst_res is None:
+            dst_res = [200]
+        self.dst_res = dst_res
+        if landsat_cache_dir is None:
+            landsat_cache_dir = path.join(tmp_dir, 'landsat-scenes')
+        self.landsat_cache_dir = landsat_cache_dir
+        self.force = force
+
+        # in-memory outputs of the stages and path to the files where they
+        # have been dumped (if any)
+        self.results = {}
+        self.filepaths = {}
+
+    def _get_filepath(self, filepath):
+        return path.join(self.root_dir, filepath)
+
+    def _get_agglom_extent_gdf(self):
+        return gpd.read_file(self._get_filepath(AGGLOM_EXTENT_SHP))
+
+    def plan(self, targets):
+        # get the stages that need to be run and those whose output can be
+        # loaded from an existing file, i.e., those that are not targets
+        # (unless `force` is True). The dependencies of the latter are not
+        # needed
+        run_stages, load_stages = [], []
+
+        def add_stage(stage, is_target):
+            if stage in run_stages or stage in load_stages:
+                return
+            if not is_target and not self.force and path.exists(
+                    self._get_filepath(STAGES[stage][1])):
+                load_stages.append(stage)
+                return
+            for dep in STAGES[stage][0]:
+                add_stage(dep, False)
+            run_stages.append(stage)
+
+        for target in targets:
+            add_stage(target, True)
+        return run_stages, load_stages
+
+    def run(self, targets, n_jobs=None):
+        # run the stages needed to obtain `targets` in this process, passing
+        # the in-memory outputs between stages. Independent stages (e.g., the
+        # regression and InVEST branches) run concurrently in up to `n_jobs`
+        # threads, and the outputs are only dumped for the targets (and for
+        # the stages whose outputs are read from files by further stages)
+        logger = logging.getLogger(__name__)
+
+        run_stages, load_stages = self.plan(targets)
+        file_stages = [
+            stage for stage in FILE_STAGES if any(
+                stage in STAGES[consumer_stage][0]
+                for consumer_stage in FILE_CONSUMER_STAGES
+                if consumer_stage in run_stages)
+        ]
+        for stage in load_stages:
+            filepath = self._get_filepath(STAGES[stage][1])
+            self.results[stage] = getattr(self, f'load_{stage}')(filepath)
+            self.filepaths[stage] = filepath
+            logger.info("loaded %s from %s", stage, filepath)
+
+        def run_stage(stage):
+            self.results[stage] = getattr(self, f'run_{stage}')()
+            if stage in targets:
+                filepath = self._get_filepath(STAGES[stage][1])
+                os.makedirs(path.dirname(filepath), exist_ok=True)
+            elif stage in file_stages:
+                filepath = path.join(self.tmp_dir,
+                                     path.basename(STAGES[stage][1]))
+            else:
+                return
+            getattr(self, f'dump_{stage}')(self.results[stage], filepath)
+            self.filepaths[stage] = filepath
+            logger.info("dumped %s to %s", stage, filepath)
+
+        pending_stages = list(run_stages)
+        completed_stages = set(load_stages)
+        running_stages = {}
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            while pending_stages or running_stages:
+                # submit the stages whose dependencies are completed
+                for stage in list(pending_stages):
+                    if completed_stages.issuperset(STAGES[stage][0]):
+                        running_stages[executor.submit(run_stage,
+                                                       stage)] = stage
+                        pending_stages.remove(stage)
+                done, _ = futures.wait(running_stages,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running_stages.pop(future)
+                    # raise the stage's exception (if any)
+                    future.result()
+                    completed_stages.add(stage)
+                    logger.info("completed stage %s", stage)
+
+    # 1. shade
+    def run_biophysical_table_shade(self):
+        from lausanne_heat_islands import make_biophysical_table_shade
+
+        return make_biophysical_table_shade.get_biophysical_shade_df(
+            self._get_filepath(AGGLOM_LULC_TIF),
+            self._get_filepath(TREE_CANOPY_TIF),
+            pd.read_csv(self._get_filepath(BIOPHYSICAL_TABLE_CSV)))
+
+    def dump_biophysical_table_shade(self, biophysical_df, filepath):
+        biophysical_df.to_csv(filepath)
+
+    def load_biophysical_table_shade(self, filepath):
+        return pd.read_csv(filepath, index_col=0)
+
+    # 2. station measurements
+    def run_station_measurements(self):
+        from lausanne_heat_islands import make_station_tair_df
+
+        station_tair_df = make_station_tair_df.get_station_tair_df(
+            pd.read_csv(self._get_filepath(LANDSAT_TILES_CSV),
+                        header=None)[0],
+            self._get_filepath(STATION_RAW_DIR),
+            store_dir=self._get_filepath(STATION_STORE_DIR))
+        # string station names, as when read from the dumped file
+        station_tair_df.columns = station_tair_df.columns.astype(str)
+        return station_tair_df
+
+    def dump_station_measurements(self, station_tair_df, filepath):
+        station_tair_df.to_csv(filepath)
+
+    def load_station_measurements(self, filepath):
+        return pd.read_csv(filepath, index_col=0)
+
+    # 3. regression
+    def run_landsat_features(self):
+        from lausanne_heat_islands.regression import make_landsat_features
+
+        # the scenes are streamed to files that are lazily concatenated
+        os.makedirs(self.landsat_cache_dir, exist_ok=True)
+        return make_landsat_features.open_landsat_features_ds(
+            make_landsat_features.dump_scene_datasets(
+                pd.read_csv(self._get_filepath(LANDSAT_TILES_CSV),
+                            header=None)[0], self._get_agglom_extent_gdf(),
+                self.landsat_cache_dir))
+
+    def dump_landsat_features(self, landsat_features_ds, filepath):
+        utils.dump_dataset(landsat_features_ds, filepath)
+
+    def load_landsat_features(self, filepath):
+        return utils.open_dataset(filepath)
+
+    def run_regression_df(self):
+        from lausanne_heat_islands.regression import make_regression_df
+
+        return make_regression_df.get_regression_df(
+            pd.read_csv(self._get_filepath(STATION_LOCATIONS_CSV),
+                        index_col=0), self.results['station_measurements'],
+            self.results['landsat_features'])
+
+    def dump_regression_df(self, regression_df, filepath):
+        regression_df.to_csv(filepath)
+
+    def load_regression_df(self, filepath):
+        return pd.read_csv(filepath, index_col=[0, 1])
+
+    def run_regressor(self):
+        from lausanne_heat_islands.regression import make_regressor
+
+        return make_regressor.train_regressor(self.results['regression_df'])
+
+    def dump_regressor(self, regr, filepath):
+        jl.dump(regr, filepath)
+
+    def load_regressor(self, filepath):
+        return jl.load(filepath)
+
+    def run_tair_regr_maps(self):
+        from lausanne_heat_islands.regression import make_tair_regr_maps
+
+        return make_tair_regr_maps.get_tair_regr_maps(
+            self._get_agglom_extent_gdf(),
+            self.results['station_measurements'],
+            self.results['landsat_features'],
+            self._get_filepath(SWISS_DEM_TIF), self.results['regressor'],
+            self.dst_res)
+
+    def dump_tair_regr_maps(self, T_pred_da_dict, filepath):
+        for _dst_res, _dst_filepath in utils.get_res_filepaths(
+                filepath, self.dst_res).items():
+            utils.dump_dataset(T_pred_da_dict[_dst_res],
+                               _dst_filepath,
+                               chunk_layout='time')
+
+    # 4. InVEST urban cooling model
+    def run_ref_et(self):
+        from lausanne_heat_islands.invest import make_ref_et
+
+        return make_ref_et.get_ref_et_da(self._get_filepath(AGGLOM_LULC_TIF),
+                                         self._get_agglom_extent_gdf(),
+                                         self.results['station_measurements'])
+
+    def dump_ref_et(self, ref_eto_da, filepath):
+        utils.dump_dataset(ref_eto_da, filepath)
+
+    def load_ref_et(self, filepath):
+        return utils.open_dataarray(filepath)
+
+    def run_calibrate_ucm(self):
+        from lausanne_heat_islands.invest import make_calibrate_ucm
+
+        # start from the default x0 of the calibration command
+        defaults = {
+            param.name: param.default
+            for param in make_calibrate_ucm.main.params
+        }
+        model_params, _, _ = make_calibrate_ucm.calibrate_ucm(
+            self._get_filepath(AGGLOM_LULC_TIF),
+            self.filepaths['biophysical_table_shade'],
+            self.filepaths['ref_et'],
+            self._get_filepath(STATION_LOCATIONS_CSV),
+            self.filepaths['station_measurements'], [
+                defaults[param] for param in [
+                    'x0_tair_avg_radius', 'x0_green_area_cooling_dist',
+                    'x0_w_shade', 'x0_w_albedo', 'x0_w_eti'
+                ]
+            ])
+        return model_params
+
+    def dump_calibrate_ucm(self, model_params, filepath):
+        with open(filepath, 'w') as dst:
+            json.dump(model_params, dst)
+
+    def load_calibrate_ucm(self, filepath):
+        with open(filepath) as src:
+            return json.load(src)
+
+    def run_tair_ucm_maps(self):
+        from lausanne_heat_islands.invest import make_tair_ucm_maps
+
+        return make_tair_ucm_maps.get_tair_ucm_maps(
+            self.results['calibrate_ucm'], self._get_agglom_extent_gdf(),
+            self._get_filepath(AGGLOM_LULC_TIF),
+            self.filepaths['biophysical_table_shade'],
+            self.filepaths['ref_et'],
+            self.filepaths['station_measurements'],
+            self._get_filepath(STATION_LOCATIONS_CSV), self.dst_res)
+
+    def dump_tair_ucm_maps(self, T_ucm_da_dict, filepath):
+        for _dst_res, _dst_filepath in utils.get_res_filepaths(
+                filepath, self.dst_res).items():
+            utils.dump_dataset(T_ucm_da_dict[_dst_res],
+                               _dst_filepath,
+                               chunk_layout='time')
+
+
+@click.command()
+@click.argument('targets',
+                nargs=-1,
+                required=True,
+                type=click.Choice(list(STAGES)))
+@click.option('--root-dir', type=click.Path(exists=True), default='.')
+@click.option('--dst-res', type=int, multiple=True, default=[200])
+@click.option('--landsat-cache-dir', type=click.Path())
+@click.option('--force', is_flag=True)
+@click.option('--n-jobs', type=int)
+def main(targets, root_dir, dst_res, landsat_cache_dir, force, n_jobs):
+    # disable InVEST's logging
+    for module in ('natcap.invest.urban_cooling_model', 'natcap.invest.utils',
+                   'pygeoprocessing.geoprocessing', 'taskgraph.Task'):
+        logging.getLogger(module).setLevel(logging.WARNING)
+    # ignore all warnings
+    warnings.filterwarnings('ignore')
+
+    # the intermediate outputs that are not requested but need to be dumped
+    # (see `FILE_STAGES`) as well as the landsat scenes (unless
+    # `landsat_cache_dir` is provided) go to a temporary directory
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        Pipeline(root_dir,
+                 tmp_dir,
+                 dst_res=list(dst_res),
+                 landsat_cache_dir=landsat_cache_dir,
+                 force=force).run(targets, n_jobs=n_jobs)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=settings.DEFAULT_LOG_FMT)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    dotenv.load_dotenv(dotenv.find_dotenv())
+
+    main()
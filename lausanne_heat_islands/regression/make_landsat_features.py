@@ -1,5 +1,11 @@
+import functools
+import hashlib
+import json
 import logging
 import os
+import shutil
+import tempfile
+from concurrent import futures
 from os import path
 
 import click
@@ -7,49 +13,208 @@ import geopandas as gpd
 import pandas as pd
 import swiss_uhi_utils as suhi
 import xarray as xr
+from pylandsat import utils as pylandsat_utils
 
 from lausanne_heat_islands import settings, utils
 
 
+def _dump_landsat_features_ds(landsat_tile, dst_filepath,
+                              **landsat_features_kws):
+    # compute the features of a single scene and dump them to `dst_filepath`
+    # so that they do not need to be kept in memory (nor sent back from a
+    # worker process)
+    utils.dump_dataset(
+        suhi.get_landsat_features_ds(landsat_tile, **landsat_features_kws),
+        dst_filepath)
+    return dst_filepath
+
+
+def _get_cache_key(buffer_dist,
+                   landsat_features,
+                   ref_geom,
+                   water_bodies_geom,
+                   crs,
+                   ref_grid=None):
+    # the features of a scene depend on these arguments (besides the product
+    # id), so a cached scene can only be reused if all of them match. The
+    # scenes are aligned to the grid of the reference scene, i.e., `ref_grid`
+    # (None for the reference scene itself)
+    return hashlib.sha1(
+        json.dumps([
+            buffer_dist, landsat_features, ref_geom.wkb_hex,
+            water_bodies_geom.wkb_hex,
+            str(crs),
+            None if ref_grid is None else utils._get_grid_key(ref_grid)
+        ],
+                   sort_keys=True).encode()).hexdigest()[:16]
+
+
+def dump_scene_datasets(landsat_tiles,
+                        agglom_extent_gdf,
+                        cache_dir,
+                        buffer_dist=2000,
+                        n_jobs=1,
+                        skip_dates=None):
+    # compute the features of each landsat tile (product id) of
+    # `landsat_tiles` and stream the dataset of each scene to its own file in
+    # `cache_dir`, where the files persist so that only the scenes that have
+    # not been computed before need to be computed. The scenes whose date is
+    # in `skip_dates` are not processed. Returns a series of the scene file
+    # paths indexed by the landsat tiles
+    logger = logging.getLogger(__name__)
+
+    # get the agglomeration and lake extents
+    crs = agglom_extent_gdf.crs
+    ref_geom = agglom_extent_gdf.loc[0]['geometry'].buffer(buffer_dist)
+    lake_geom = agglom_extent_gdf.loc[1]['geometry']
+
+    # process the list of tiles
+    landsat_features = ['lst', 'ndwi']
+    landsat_features_kws = dict(landsat_features=landsat_features,
+                                ref_geom=ref_geom,
+                                water_bodies_geom=lake_geom,
+                                crs=crs)
+
+    # use a head-tail pattern to get a reference dataset from the first
+    # tile and use it to align the datasets of further tiles
+    ref_filepath = path.join(
+        cache_dir, f'{landsat_tiles[0]}-' +
+        _get_cache_key(buffer_dist, landsat_features, ref_geom, lake_geom,
+                       crs) + '.nc')
+    if path.exists(ref_filepath):
+        ref_ds = utils.open_dataset(ref_filepath).load()
+    else:
+        ref_ds = suhi.get_landsat_features_ds(landsat_tiles[0],
+                                              **landsat_features_kws)
+        utils.dump_dataset(ref_ds, ref_filepath)
+
+    # the cached scenes of further tiles can only be reused if they have been
+    # aligned to the same reference grid (e.g., the first tile might differ
+    # from the previous runs)
+    cache_key = _get_cache_key(buffer_dist,
+                               landsat_features,
+                               ref_geom,
+                               lake_geom,
+                               crs,
+                               ref_grid=utils._get_grid(ref_ds))
+    scene_filepath_ser = pd.Series([ref_filepath] + [
+        path.join(cache_dir, f'{landsat_tile}-{cache_key}.nc')
+        for landsat_tile in landsat_tiles[1:]
+    ],
+                                   index=landsat_tiles)
+
+    if skip_dates is not None:
+        scene_filepath_ser = scene_filepath_ser[[
+            pd.Timestamp(
+                pylandsat_utils.meta_from_pid(landsat_tile)
+                ['acquisition_date']).normalize() not in skip_dates
+            for landsat_tile in landsat_tiles
+        ]]
+
+    # the remaining scenes are independent from each other and can thus
+    # be processed in parallel
+    missing_scene_filepath_ser = scene_filepath_ser[
+        ~scene_filepath_ser.map(path.exists)]
+    dump_landsat_features_ds = functools.partial(_dump_landsat_features_ds,
+                                                 ref_ds=ref_ds,
+                                                 **landsat_features_kws)
+    if n_jobs == 1:
+        for landsat_tile in missing_scene_filepath_ser.index:
+            dump_landsat_features_ds(landsat_tile,
+                                     missing_scene_filepath_ser[landsat_tile])
+    else:
+        with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # consume the iterator so that worker exceptions are raised
+            list(
+                executor.map(dump_landsat_features_ds,
+                             missing_scene_filepath_ser.index,
+                             missing_scene_filepath_ser))
+    logger.info("computed landsat features for %d scenes (%d found in cache)",
+                len(missing_scene_filepath_ser),
+                len(scene_filepath_ser) - len(missing_scene_filepath_ser))
+
+    return scene_filepath_ser
+
+
+def open_landsat_features_ds(scene_filepaths):
+    # lazily concatenate the scenes so that they are not all loaded into
+    # memory
+    return xr.concat([
+        utils.open_dataset(scene_filepath)
+        for scene_filepath in scene_filepaths
+    ],
+                     dim='time').sortby('time')
+
+
 @click.command()
 @click.argument('landsat_tiles_filepath', type=click.Path(exists=True))
 @click.argument('agglom_extent_filepath', type=click.Path(exists=True))
 @click.argument('dst_filepath', type=click.Path())
 @click.option('--buffer-dist', default=2000)
+@click.option('--n-jobs', '--jobs', type=int, default=1)
+@click.option('--cache-dir', type=click.Path())
+@click.option('--append', is_flag=True)
+@utils.stage_cache(bypass_params=['append'])
 def main(landsat_tiles_filepath, agglom_extent_filepath, dst_filepath,
-         buffer_dist):
+         buffer_dist, n_jobs, cache_dir, append):
     logger = logging.getLogger(__name__)
 
     # read list of landsat tiles (product ids) to process
     landsat_tiles = pd.read_csv(landsat_tiles_filepath, header=None)[0]
 
-    # get the agglomeration and lake extents
-    agglom_extent_gdf = gpd.read_file(agglom_extent_filepath)
-    crs = agglom_extent_gdf.crs
-    ref_geom = agglom_extent_gdf.loc[0]['geometry'].buffer(buffer_dist)
-    lake_geom = agglom_extent_gdf.loc[1]['geometry']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # if a cache directory is provided, the scene files persist across
+        # runs
+        if cache_dir is None:
+            cache_dir = tmp_dir
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
 
-    # process the list of tiles
-    datasets = []
-    # use a head-tail pattern to get a reference dataset in the first
-    # iteration and use it to align the datasets of further iterations
-    landsat_features_kws = dict(landsat_features=['lst', 'ndwi'],
-                                ref_geom=ref_geom,
-                                water_bodies_geom=lake_geom,
-                                crs=crs)
-    ref_ds = suhi.get_landsat_features_ds(landsat_tiles[0],
-                                          **landsat_features_kws)
-    datasets.append(ref_ds)
-    for landsat_tile in landsat_tiles[1:]:
-        ds = suhi.get_landsat_features_ds(landsat_tile,
-                                          ref_ds=ref_ds,
-                                          **landsat_features_kws)
-        datasets.append(ds)
-
-    agglom_landsat_ds = xr.concat(datasets, dim='time')
-    if path.exists(dst_filepath):
-        os.remove(dst_filepath)
-    agglom_landsat_ds.to_netcdf(dst_filepath)
+        # in append mode, only the scenes whose date is not in the existing
+        # dataset at `dst_filepath` need to be processed
+        append = append and path.exists(dst_filepath)
+        if append:
+            with utils.open_dataset(dst_filepath) as dst_ds:
+                skip_dates = pd.to_datetime(dst_ds['time'].values).normalize()
+        else:
+            skip_dates = None
+        scene_filepath_ser = dump_scene_datasets(
+            landsat_tiles,
+            gpd.read_file(agglom_extent_filepath),
+            cache_dir,
+            buffer_dist=buffer_dist,
+            n_jobs=n_jobs,
+            skip_dates=skip_dates)
+
+        # lazily concatenate the scenes so that they are written to the
+        # destination file without loading all of them into memory
+        if append:
+            if scene_filepath_ser.empty:
+                logger.info("no new scenes to append to %s", dst_filepath)
+                return
+            # extend the existing dataset (write it to a temporary file first
+            # since we are reading from `dst_filepath`)
+            datasets = [utils.open_dataset(dst_filepath)]
+            _dst_filepath = path.join(tmp_dir, path.basename(dst_filepath))
+        else:
+            datasets = []
+            _dst_filepath = dst_filepath
+        datasets += [
+            utils.open_dataset(scene_filepath)
+            for scene_filepath in scene_filepath_ser
+        ]
+        # the (time, y, x) arrays are read by dates, so use a tile layout
+        utils.dump_dataset(
+            xr.concat(datasets, dim='time').sortby('time'), _dst_filepath)
+        for ds in datasets:
+            ds.close()
+        if append:
+            # replace the existing dataset (a Zarr store is a directory)
+            if path.isdir(dst_filepath):
+                shutil.rmtree(dst_filepath)
+            else:
+                os.remove(dst_filepath)
+            shutil.move(_dst_filepath, dst_filepath)
     logger.info("dumped landsat features dataset to %s", dst_filepath)
 
 
@@ -13,70 +13,38 @@ from lausanne_heat_islands.regression import utils as regr_utils
 
 def get_savg_feature_arr(landsat_feature_da, station_tair_df,
                          station_location_gser, kernel_dict):
-    # prepare final array
-    landsat_feature_arr = np.zeros(
-        (len(kernel_dict) + 1, *station_tair_df.shape),
-        dtype=station_tair_df.values.dtype)
-
-    # TODO: what is the best way to nest the i, j for loops?
-    # we assume that reading the TIF files is the most expensive operation and
-    # thus nest the loops accordingly (but further profiling would be
-    # interesting)
     grid = landsat_feature_da.salem.grid
-    width, height = grid.nx, grid.ny
-    cols, rows = landsat_feature_da.salem.grid.transform(
-        station_location_gser.x,
-        station_location_gser.y,
-        crs=station_location_gser.crs,
-        nearest=True)
-
-    for j, dt in enumerate(station_tair_df.index):
-        landsat_arr = landsat_feature_da.sel(time=dt).values
-
-        # first (i=0), no averaging
-        landsat_feature_arr[0][j] = landsat_arr[rows, cols]
-        for i, (pixel_radius, kernel_arr) in enumerate(kernel_dict.items(),
-                                                       start=1):
-            padded_landsat_arr = np.zeros(
-                (height + 2 * pixel_radius, width + 2 * pixel_radius),
-                dtype=landsat_arr.dtype)
-            padded_landsat_arr[pixel_radius:height +
-                               pixel_radius, pixel_radius:width +
-                               pixel_radius] = landsat_arr
-            kernel_height, kernel_width = kernel_arr.shape
-            date_radius_row = []
-            for row, col in zip(rows, cols):
-                # print(i, j, row, col, row - pixel_radius,
-                #       row + pixel_radius + 1, col - pixel_radius,
-                #       col + pixel_radius + 1)
-                # conv = kernel_arr * padded_landsat_arr[
-                #     row - pixel_radius:row + pixel_radius + 1,
-                #     col - pixel_radius:col + pixel_radius + 1]
-                conv = kernel_arr * padded_landsat_arr[row:row +
-                                                       kernel_height, col:col +
-                                                       kernel_width]
-                date_radius_row.append(conv.sum() / np.count_nonzero(conv))
-            landsat_feature_arr[i][j] = date_radius_row
-
-    # now we swap the axes to get an array where the first, second and third
-    # axes correspond to the stations, dates and averaging radii respectively.
-    return np.swapaxes(landsat_feature_arr, 0, 2)
-
-
-@click.command()
-@click.argument('station_locations_filepath', type=click.Path(exists=True))
-@click.argument('station_tair_filepath', type=click.Path(exists=True))
-@click.argument('landsat_features_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-def main(station_locations_filepath, station_tair_filepath,
-         landsat_features_filepath, dst_filepath):
-    logger = logging.getLogger(__name__)
-
-    # preprocess geo data frame of station locations (and altitude)
-    station_location_df = pd.read_csv(station_locations_filepath, index_col=0)
-
-    # landsat features
-    landsat_features_ds = xr.open_dataset(landsat_features_filepath)
+    cols, rows = grid.transform(station_location_gser.x,
+                                station_location_gser.y,
+                                crs=station_location_gser.crs,
+                                nearest=True)
+    # `transform` returns masked arrays
+    rows, cols = (np.asarray(coords).ravel() for coords in (rows, cols))
+
+    # only read the pixels around each station (for all the dates at once),
+    # so that the scenes are never loaded as a whole
+    landsat_feature_da = landsat_feature_da.sel(
+        time=station_tair_df.index).transpose('time', 'y', 'x')
+    # first (radius 0), no averaging (the pixel of each station)
+    feature_arr = landsat_feature_da.isel(
+        y=xr.DataArray(rows, dims='station'),
+        x=xr.DataArray(cols, dims='station')).values
+    savg_arr = regr_utils.get_savg_arr_at(landsat_feature_da, rows, cols,
+                                          kernel_dict)
+
+    # the axes of the resulting array correspond to the stations, dates and
+    # averaging radii respectively
+    return np.concatenate([feature_arr[np.newaxis], savg_arr]).transpose(
+        2, 1, 0).astype(station_tair_df.values.dtype)
+
+
+def get_regression_df(station_location_df, station_tair_df,
+                      landsat_features_ds):
+    # assemble the regression data frame from the data frames of station
+    # locations (and altitude) and air temperature measurements and the
+    # dataset of landsat features. The scenes of the dates of
+    # `station_tair_df` are the only ones that are read from
+    # `landsat_features_ds`, which can thus be lazily opened
 
     # reproject the `station_tair_df`
     station_location_gser = gpd.GeoSeries(gpd.points_from_xy(
@@ -88,8 +56,7 @@ def main(station_locations_filepath, station_tair_filepath,
     # preprocess air temperature station measurements data frame
     # by selecting the columns of `station_location_df.index` we ensure that
     # the list of stations is in the same order in both data frames
-    station_tair_df = pd.read_csv(station_tair_filepath,
-                                  index_col=0)[station_location_df.index]
+    station_tair_df = station_tair_df[station_location_df.index]
     station_tair_df.index = pd.to_datetime(station_tair_df.index)
 
     # prepare regression data frame
@@ -128,11 +95,28 @@ def main(station_locations_filepath, station_tair_filepath,
             station_column,
             'elev')] = station_location_df.loc[station_column, 'alt']
 
-    # dump it (need to dump the index here)
     # use the `[utils.REGRESSION_DF_COLUMNS]` to ensure a consistent column
     # ordering after `stack`
-    regression_df.stack(level=0)[
-        regr_utils.REGRESSION_DF_COLUMNS].dropna().to_csv(dst_filepath)
+    return regression_df.stack(
+        level=0)[regr_utils.REGRESSION_DF_COLUMNS].dropna()
+
+
+@click.command()
+@click.argument('station_locations_filepath', type=click.Path(exists=True))
+@click.argument('station_tair_filepath', type=click.Path(exists=True))
+@click.argument('landsat_features_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@utils.stage_cache()
+def main(station_locations_filepath, station_tair_filepath,
+         landsat_features_filepath, dst_filepath):
+    logger = logging.getLogger(__name__)
+
+    regression_df = get_regression_df(
+        pd.read_csv(station_locations_filepath, index_col=0),
+        pd.read_csv(station_tair_filepath, index_col=0),
+        utils.open_dataset(landsat_features_filepath))
+    # dump it (need to dump the index here)
+    regression_df.to_csv(dst_filepath)
     logger.info("dumped air temperature regression data frame to %s",
                 dst_filepath)
 
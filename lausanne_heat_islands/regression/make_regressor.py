@@ -5,18 +5,12 @@ import joblib as jl
 import pandas as pd
 from sklearn import linear_model, metrics
 
-from lausanne_heat_islands import settings
+from lausanne_heat_islands import settings, utils
 
 
-@click.command()
-@click.argument('regression_df_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-@click.option('--target-column', default='tair_station')
-def main(regression_df_filepath, dst_filepath, target_column):
+def train_regressor(regression_df, target_column='tair_station'):
     logger = logging.getLogger(__name__)
 
-    regression_df = pd.read_csv(regression_df_filepath, index_col=[0, 1])
-
     y = regression_df[target_column]
     X = regression_df.drop(target_column, axis=1)
     # regr = ensemble.RandomForestRegressor().fit(X, y)
@@ -28,6 +22,20 @@ def main(regression_df_filepath, dst_filepath, target_column):
     logger.info("trained linear regressor with R^2 %.4f and RMSE %.4f",
                 regr.score(X, y),
                 metrics.mean_squared_error(y, regr.predict(X), squared=False))
+    return regr
+
+
+@click.command()
+@click.argument('regression_df_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--target-column', default='tair_station')
+@utils.stage_cache()
+def main(regression_df_filepath, dst_filepath, target_column):
+    logger = logging.getLogger(__name__)
+
+    regr = train_regressor(pd.read_csv(regression_df_filepath,
+                                       index_col=[0, 1]),
+                           target_column=target_column)
 
     # dump the chosen model
     jl.dump(regr, dst_filepath)
@@ -7,95 +7,119 @@ import numpy as np
 import pandas as pd
 import salem  # noqa: F401
 import xarray as xr
-from scipy import ndimage as ndi
 
 from lausanne_heat_islands import settings, utils
 from lausanne_heat_islands.regression import utils as regr_utils
 
+# number of pixels (rows of the feature matrix) passed to the regressor at once
+PREDICT_CHUNK_SIZE = 2**20
 
-def get_savg_feature_ds(day_da, kernel_dict):
-    ds = day_da.to_dataset()
-    name = day_da.name
-    # drop the feature
-    ds = ds.drop_vars(name)
+
+def get_savg_feature_ds(feature_da, kernel_dict):
+    # spatially average the feature for all the dates of the (time, y, x) data
+    # array at once (the kernel spectra are thus computed only once), with
+    # the same (nan-aware) definition of the average as for the regression
+    # features (see `make_regression_df.get_savg_feature_arr`)
+    name = feature_da.name
     # first: radius 0 (no averaging)
-    ds[f'{name}_0'] = day_da
-    for pixel_radius, averaging_radius in zip(kernel_dict,
-                                              regr_utils.AVERAGING_RADII[1:]):
-        kernel_arr = kernel_dict[pixel_radius]
-        ds[f'{name}_{averaging_radius}'] = xr.apply_ufunc(
-            lambda da: ndi.convolve(da, kernel_arr) / kernel_arr.sum(), day_da)
+    ds = xr.Dataset({f'{name}_0': feature_da})
+    for averaging_radius, savg_arr in zip(
+            regr_utils.AVERAGING_RADII[1:],
+            regr_utils.get_savg_arr(feature_da.values, kernel_dict)):
+        ds[f'{name}_{averaging_radius}'] = feature_da.copy(data=savg_arr)
     return ds
 
 
-def predict_T(regr, landsat_features_ds, dem_arr, T_nodata=np.nan):
-    features = []
-    for landsat_feature in regr_utils.LANDSAT_FEATURES:
-        features.append(landsat_features_ds[landsat_feature].values.flatten())
-    features.append(dem_arr.flatten())
-    X = np.column_stack(features)
-
+def predict_T(regr,
+              landsat_features_ds,
+              dem_arr,
+              T_nodata=np.nan,
+              chunk_size=PREDICT_CHUNK_SIZE):
+    # predict the air temperature of all the dates of `landsat_features_ds` at
+    # once, i.e., stack the features of all the dates into a single matrix
+    num_dates = landsat_features_ds.sizes['time']
+    X = np.empty((num_dates, dem_arr.size, len(regr_utils.FEATURES)),
+                 dtype=np.float32)
+    for i, landsat_feature in enumerate(regr_utils.LANDSAT_FEATURES):
+        X[:, :, i] = landsat_features_ds[landsat_feature].transpose(
+            'time', 'y', 'x').values.reshape(num_dates, -1)
+    X[:, :, -1] = dem_arr.ravel()
+    X = X.reshape(-1, X.shape[-1])
+
+    # predict only the rows without missing features, in chunks of
+    # `chunk_size` rows so that the regressor's memory usage is bounded
     T_pred_arr = np.full(X.shape[0], T_nodata)
-    data_idx = ~pd.DataFrame(X).isna().any(axis=1)
-    T_pred_arr.ravel()[data_idx] = regr.predict(X[data_idx])
-
-    return T_pred_arr.reshape(dem_arr.shape)
+    data_idx = np.flatnonzero(~np.isnan(X).any(axis=1))
+    for start in range(0, len(data_idx), chunk_size):
+        chunk_idx = data_idx[start:start + chunk_size]
+        T_pred_arr[chunk_idx] = regr.predict(X[chunk_idx])
+
+    return T_pred_arr.reshape(num_dates, *dem_arr.shape)
+
+
+def get_tair_regr_maps(agglom_extent_gdf,
+                       station_tair_df,
+                       landsat_features_ds,
+                       swiss_dem_filepath,
+                       regr,
+                       dst_res,
+                       buffer_dist=2000,
+                       chunk_size=PREDICT_CHUNK_SIZE,
+                       roi_mask_cache_dir=None):
+    # compute the air temperature maps of the dates of `station_tair_df` with
+    # the trained regressor `regr`, and return a dict mapping each target
+    # resolution of `dst_res` to its data array. The scenes of these dates
+    # are the only ones that are read from `landsat_features_ds`, which can
+    # thus be lazily opened
 
-
-@click.command()
-@click.argument('agglom_extent_filepath', type=click.Path(exists=True))
-@click.argument('station_tair_filepath', type=click.Path(exists=True))
-@click.argument('landsat_features_filepath', type=click.Path(exists=True))
-@click.argument('swiss_dem_filepath', type=click.Path(exists=True))
-@click.argument('regressor_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-@click.option('--dst-res', type=int, default=200)
-@click.option('--buffer-dist', type=int, default=2000)
-def main(agglom_extent_filepath, station_tair_filepath,
-         landsat_features_filepath, swiss_dem_filepath, regressor_filepath,
-         dst_filepath, dst_res, buffer_dist):
-    logger = logging.getLogger(__name__)
-
-    # Compute an air temperature array from the trained regressor
     # 0. Preprocess the inputs
     # get the agglomeration extent
-    agglom_extent_gdf = gpd.read_file(agglom_extent_filepath)
     crs = agglom_extent_gdf.crs
     data_geom = agglom_extent_gdf.loc[0]['geometry']
     # add a buffer to compute the convolution features well
     ref_geom = data_geom.buffer(buffer_dist)
 
+    # the features and predictions are computed only once at the finest
+    # target resolution, and then aggregated to the coarser ones, which must
+    # thus be multiples of the finest (see `main`)
+    min_dst_res = min(dst_res)
+
     # use the ref geometry to obtain the reference grid (data array) with the
-    # target resolution
-    ref_da = utils.get_ref_da(ref_geom, dst_res, dst_fill=0, dst_crs=crs)
+    # finest target resolution
+    ref_da = utils.get_ref_da(ref_geom, min_dst_res, dst_fill=0, dst_crs=crs)
 
-    # read the dates from the air temperature station measurements data frame
+    # get the dates from the air temperature station measurements data frame
     # we need at least series to groupby year and access the group series
     # whose index will be the dates in its respective year
-    date_ser = pd.Series(0,
-                         index=pd.to_datetime(
-                             pd.read_csv(station_tair_filepath,
-                                         index_col=0).index))
+    date_ser = pd.Series(0, index=pd.to_datetime(station_tair_df.index))
 
     # 1. Prepare the regression features
     # 1.1-1.2 Landsat features
-    # open the dataset
-    landsat_features_ds = xr.open_dataset(landsat_features_filepath)
+    # select only the dates that we need
+    landsat_features_ds = landsat_features_ds.sel(time=date_ser.index)
     # note that we need to forward the dataset attributes to its data variables
     for data_var in landsat_features_ds.data_vars:
         landsat_features_ds[data_var].attrs = landsat_features_ds.attrs.copy()
-    # align it
-    landsat_features_ds = ref_da.salem.transform(landsat_features_ds,
-                                                 interp='linear')
+    # align it (with cached regridding weights, all the features and dates at
+    # once)
+    landsat_features_ds = utils.regrid(ref_da,
+                                       landsat_features_ds,
+                                       interp='linear')
     # spatial averaging
-    kernel_dict = regr_utils.get_kernel_dict(res=dst_res)
+    kernel_dict = regr_utils.get_kernel_dict(res=min_dst_res)
     for landsat_feature in regr_utils.LANDSAT_BASE_FEATURES:
         landsat_features_ds = landsat_features_ds.assign(
-            landsat_features_ds[landsat_feature].groupby('time').map(
-                get_savg_feature_ds,
-                args=(kernel_dict, ))).drop(landsat_feature)
-    landsat_features_ds = landsat_features_ds.salem.subset(geometry=data_geom,
-                                                           crs=crs)
+            get_savg_feature_ds(landsat_features_ds[landsat_feature],
+                                kernel_dict)).drop(landsat_feature)
+    # keep a margin of a pixel of the coarsest target resolution so that the
+    # aggregated maps cover the grids of all the target resolutions (see
+    # step 3)
+    landsat_features_ds = utils.subset(
+        landsat_features_ds,
+        data_geom,
+        crs,
+        margin=utils.get_block_factor(min_dst_res, max(dst_res)),
+        cache_dir=roi_mask_cache_dir)
 
     # 1.3 Elevation
     # dem_s3_filepath = path.join(bucket_name, dem_file_key)
@@ -103,17 +127,16 @@ def main(agglom_extent_filepath, station_tair_filepath,
     # dem_da = utils.salem_da_from_singleband(swiss_dem_filepath)
     dem_da = salem.open_xr_dataset(swiss_dem_filepath)['data']
     # align it
-    dem_arr = landsat_features_ds.salem.transform(dem_da,
-                                                  interp='linear').values
+    dem_arr = utils.regrid(landsat_features_ds, dem_da,
+                           interp='linear').values
 
     # 2. Use the trained regressor to predict the air temperature at the
-    #    target resolution
-    regr = jl.load(regressor_filepath)
+    #    finest target resolution
     T_pred_da = xr.DataArray(
-        [
-            predict_T(regr, landsat_features_ds.sel(time=date), dem_arr)
-            for date in date_ser.index
-        ],
+        predict_T(regr,
+                  landsat_features_ds.sel(time=date_ser.index),
+                  dem_arr,
+                  chunk_size=chunk_size),
         dims=('time', 'y', 'x'),
         coords={
             'time': date_ser.index,
@@ -123,10 +146,86 @@ def main(agglom_extent_filepath, station_tair_filepath,
         name='T',
         attrs=landsat_features_ds.attrs)
 
-    # 3. Crop the data array to the valid data region and dump it to a file
-    T_pred_da.salem.roi(geometry=data_geom, crs=crs).to_netcdf(dst_filepath)
-    logger.info("dumped predicted air temperature data array to %s",
-                dst_filepath)
+    # 3. Aggregate the predicted data array to each target resolution by
+    #    block averaging onto the reference grid of the target resolution
+    #    cropped to the valid data region (i.e., the same grid for any
+    #    combination of target resolutions), and set the pixels outside it to
+    #    nan (the agglomeration mask of each grid is only rasterized once)
+    return {
+        _dst_res: utils.roi(utils.block_average(
+            T_pred_da,
+            _dst_res,
+            ref_obj=utils.subset(utils.get_ref_da(ref_geom,
+                                                  _dst_res,
+                                                  dst_crs=crs),
+                                 data_geom,
+                                 crs,
+                                 cache_dir=roi_mask_cache_dir)),
+                            data_geom,
+                            crs,
+                            cache_dir=roi_mask_cache_dir)
+        for _dst_res in dst_res
+    }
+
+
+def _get_dst_filepaths(kwargs):
+    # one output file for each target resolution
+    return list(
+        utils.get_res_filepaths(kwargs['dst_filepath'],
+                                kwargs['dst_res']).values())
+
+
+@click.command()
+@click.argument('agglom_extent_filepath', type=click.Path(exists=True))
+@click.argument('station_tair_filepath', type=click.Path(exists=True))
+@click.argument('landsat_features_filepath', type=click.Path(exists=True))
+@click.argument('swiss_dem_filepath', type=click.Path(exists=True))
+@click.argument('regressor_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--dst-res', type=int, multiple=True, default=[200])
+@click.option('--buffer-dist', type=int, default=2000)
+@click.option('--chunk-size', type=int, default=PREDICT_CHUNK_SIZE)
+@click.option('--roi-mask-cache-dir', type=click.Path())
+@utils.stage_cache(get_dst_filepaths=_get_dst_filepaths)
+def main(agglom_extent_filepath, station_tair_filepath,
+         landsat_features_filepath, swiss_dem_filepath, regressor_filepath,
+         dst_filepath, dst_res, buffer_dist, chunk_size, roi_mask_cache_dir):
+    logger = logging.getLogger(__name__)
+
+    # Compute an air temperature array from the trained regressor
+    # the features and predictions are computed only once at the finest
+    # target resolution, and then aggregated to the coarser ones, which must
+    # thus be multiples of the finest
+    min_dst_res = min(dst_res)
+    for _dst_res in dst_res:
+        try:
+            utils.get_block_factor(min_dst_res, _dst_res)
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint='--dst-res')
+
+    # lazily open the landsat features dataset so that only the dates that
+    # we need are read
+    T_pred_da_dict = get_tair_regr_maps(
+        gpd.read_file(agglom_extent_filepath),
+        pd.read_csv(station_tair_filepath, index_col=0),
+        utils.open_dataset(landsat_features_filepath),
+        swiss_dem_filepath,
+        jl.load(regressor_filepath),
+        dst_res,
+        buffer_dist=buffer_dist,
+        chunk_size=chunk_size,
+        roi_mask_cache_dir=roi_mask_cache_dir)
+
+    # dump the data array of each target resolution to a file (use a time
+    # layout since the maps are analyzed at the pixel level)
+    for _dst_res, _dst_filepath in utils.get_res_filepaths(
+            dst_filepath, dst_res).items():
+        utils.dump_dataset(T_pred_da_dict[_dst_res],
+                           _dst_filepath,
+                           chunk_layout='time')
+        logger.info(
+            "dumped predicted air temperature data array at %d m to %s",
+            _dst_res, _dst_filepath)
 
 
 if __name__ == '__main__':
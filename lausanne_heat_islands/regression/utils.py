@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import fft
 
 LANDSAT_RES = 30
 LANDSAT_BASE_FEATURES = ['lst', 'ndwi']
@@ -42,3 +43,101 @@ def get_kernel_dict(averaging_radii=None, res=LANDSAT_RES):
         kernel_dict[pixel_radius] = _get_circular_kernel(pixel_radius)
 
     return kernel_dict
+
+
+def get_savg_arr(arr, kernel_dict):
+    # spatially average `arr` (whose last two axes are y, x) with each of the
+    # kernels of `kernel_dict`. The average is nan-aware, i.e., it only
+    # considers the non-nan pixels within the kernel (pixels outside the array
+    # are not considered either). Convolutions are computed in the frequency
+    # domain, so that the cost does not depend on the kernel size, and the
+    # spectra of the (zero-filled) data and of its valid mask are computed
+    # only once for all the kernels. See `get_savg_arr_at` to only compute the
+    # averages at a few pixels.
+    arr = np.asarray(arr)
+    valid_arr = ~np.isnan(arr)
+    height, width = arr.shape[-2:]
+    max_pixel_radius = max(kernel_dict)
+    # pad by the largest kernel radius to avoid the circular wrap-around
+    fft_shape = [
+        fft.next_fast_len(n + 2 * max_pixel_radius, real=True)
+        for n in (height, width)
+    ]
+    # compute the transforms in double precision, otherwise the round-off
+    # error is noticeable for pixels with few valid pixels around them
+    data_fft = fft.rfft2(np.where(valid_arr, arr, 0).astype(np.float64),
+                         s=fft_shape)
+    valid_fft = fft.rfft2(valid_arr.astype(np.float64), s=fft_shape)
+
+    savg_arr = np.empty((len(kernel_dict), *arr.shape),
+                        dtype=np.result_type(arr.dtype, np.float32))
+    for i, (pixel_radius, kernel_arr) in enumerate(kernel_dict.items()):
+        kernel_fft = fft.rfft2(kernel_arr, s=fft_shape)
+        # crop the "same" part of the full convolution
+        rows = slice(pixel_radius, pixel_radius + height)
+        cols = slice(pixel_radius, pixel_radius + width)
+        kernel_sum_arr = fft.irfft2(data_fft * kernel_fft,
+                                    s=fft_shape)[..., rows, cols]
+        kernel_count_arr = fft.irfft2(valid_fft * kernel_fft,
+                                      s=fft_shape)[..., rows, cols]
+        # the frequency-domain computations leave some round-off error, so
+        # pixels without valid data within the kernel will not have an exact
+        # zero count
+        no_data_cond = kernel_count_arr < kernel_arr[kernel_arr > 0].min() / 2
+        kernel_count_arr[no_data_cond] = np.nan
+        savg_arr[i] = kernel_sum_arr / kernel_count_arr
+
+    return savg_arr
+
+
+def _get_kernel_weights(kernel_dict):
+    # embed every kernel (centered) in a square of the largest kernel size and
+    # return the flattened kernels, i.e., an array of shape (kernels, offsets)
+    max_pixel_radius = max(kernel_dict)
+    kernel_pixel_len = 2 * max_pixel_radius + 1
+    kernel_weights = np.zeros(
+        (len(kernel_dict), kernel_pixel_len, kernel_pixel_len),
+        dtype=np.float64)
+    for i, (pixel_radius, kernel_arr) in enumerate(kernel_dict.items()):
+        start = max_pixel_radius - pixel_radius
+        stop = max_pixel_radius + pixel_radius + 1
+        kernel_weights[i, start:stop, start:stop] = kernel_arr
+    return kernel_weights.reshape(len(kernel_dict), -1)
+
+
+def get_savg_arr_at(arr, rows, cols, kernel_dict):
+    # same as `get_savg_arr` but only for the pixels at `rows` and `cols`,
+    # i.e., `get_savg_arr(arr, kernel_dict)[..., rows, cols]`. Only the window
+    # of the largest kernel around each pixel is read from `arr` (with
+    # positional indexing), which can thus be a lazily opened data array. The
+    # windows are nan-padded so that the pixels outside the array are not
+    # considered, and the nan-aware averages are computed for all the pixels
+    # and kernels at once as a matrix product of the windows with the kernels
+    height, width = arr.shape[-2:]
+    max_pixel_radius = max(kernel_dict)
+    kernel_pixel_len = 2 * max_pixel_radius + 1
+    window_arr = np.full(
+        (*arr.shape[:-2], len(rows), kernel_pixel_len, kernel_pixel_len),
+        np.nan)
+    for i, (row, col) in enumerate(zip(rows, cols)):
+        row_start, col_start = (max(coord - max_pixel_radius, 0)
+                                for coord in (row, col))
+        row_stop, col_stop = (min(coord + max_pixel_radius + 1, size)
+                              for coord, size in ((row, height), (col, width)))
+        window_row, window_col = (start - coord + max_pixel_radius
+                                  for start, coord in ((row_start, row),
+                                                       (col_start, col)))
+        window_arr[..., i, window_row:window_row + row_stop - row_start,
+                   window_col:window_col + col_stop - col_start] = np.asarray(
+                       arr[..., row_start:row_stop, col_start:col_stop])
+
+    # shape (..., pixels, offsets)
+    window_arr = window_arr.reshape(*window_arr.shape[:-2], -1)
+    valid_arr = ~np.isnan(window_arr)
+    kernel_weights = _get_kernel_weights(kernel_dict)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        savg_arr = (np.where(valid_arr, window_arr, 0) @ kernel_weights.T) / (
+            valid_arr @ kernel_weights.T)
+    # move the kernels to the first axis as in `get_savg_arr`
+    return np.moveaxis(savg_arr, -1,
+                       0).astype(np.result_type(arr.dtype, np.float32))
@@ -1,199 +1,731 @@
-import geopandas as gpd
-import matplotlib.pyplot as plt
+import collections
+import functools
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+from os import environ, path
+
+import click
 import numpy as np
-import pandas as pd
-import seaborn as sns
-from matplotlib import colors
-from shapely import geometry
-from sklearn import metrics
+import xarray as xr
+
+# ACHTUNG: keep this module light to import since it is imported by every
+# `make_*` command. Heavy dependencies (salem, scipy) are imported within the
+# functions that use them, and the plotting helpers live in `plot_utils`
 
 # Swiss CRS
 CRS = 'epsg:2056'
 
-# PLOTS
-# ugly hardcoded for the legend of the error classes in map `plot_T_maps`
-ERR_CLASSES = [-5, -3, -1, 1, 3, 5]  # station markers
-ERR_BOUNDARIES = [-12, -6, -2, 2, 6, 12]  # map pixels
-
-
-def plot_pred_obs(comparison_df):
-    fig, ax = plt.subplots()
-    sns.scatterplot(x='obs', y='pred', data=comparison_df, ax=ax)
-    text_kws = dict(transform=ax.transAxes)
-    obs_ser, pred_ser = comparison_df['obs'], comparison_df['pred']
-    r_sq = metrics.r2_score(obs_ser, pred_ser)
-    mae = metrics.mean_absolute_error(obs_ser, pred_ser)
-    rmse = metrics.mean_squared_error(obs_ser, pred_ser, squared=False)
-    ax.text(0.06, 0.88, f'$R^2 = {r_sq:.4}$', **text_kws)
-    ax.text(0.06, 0.80, f'$MAE = {mae:.4} \degree C$', **text_kws)
-    ax.text(0.06, 0.72, f'$RMSE = {rmse:.4} \degree C$', **text_kws)
-    ax.set_ylabel('$\hat{T}$')
-    ax.set_xlabel('$T_{obs}$')
-
-    return fig
-
-
-def plot_err_elev_obs(comparison_df):
-    figwidth, figheight = plt.rcParams['figure.figsize']
-    fig, axes = plt.subplots(1, 2, figsize=(2 * figwidth, figheight))
-
-    # rename to have a nicer legend, also use str formatting for the date
-    # also creating a new data frame (after `rename` avoids reference issues
-    df = comparison_df.rename(columns={'date': 'Date'})
-    df['Date'] = df['Date'].dt.strftime('%Y-%m-%d')
-    df['err'] = df['pred'] - df['obs']
-
-    ax_elev = axes[0]
-    sns.scatterplot(x='elev',
-                    y='err',
-                    hue='Date',
-                    data=df,
-                    ax=ax_elev,
-                    legend=False)
-    ax_elev.set_xlabel('Elevation [m]')
-    ax_elev.set_ylabel('$\hat{T} - T_{obs}$')
-
-    ax_y = axes[1]
-    sns.scatterplot(x='obs', y='err', hue='Date', data=df, ax=ax_y)
-    ax_y.set_xlabel('$T_{obs}$')
-    ax_y.set_ylabel('')
-    ax_y.legend(loc='center right', bbox_to_anchor=(1.4, .5))
-
-    for ax in axes:
-        ax.axhline(color='gray', linestyle='--', linewidth=1)
-
-    return fig
-
-
-def plot_T_maps(T_da,
-                station_location_df,
-                num_cols=3,
-                comparison_df=None,
-                err_classes=None,
-                **plot_kws):
-    g = T_da.rename({
-        'time': 'date'
-    }).plot(
-        x='x',
-        y='y',
-        col='date',
-        col_wrap=num_cols,
-        # cbar_kwargs={
-        #     'shrink': .2,
-        #     'pad': 0.02,
-        # }
-        add_colorbar=False,
-        **plot_kws)
-
-    # post-processing
-    fig = g.fig
-    flat_axes = g.axes.flatten()
-
-    # prepare last axis for the legend
-    last_ax = flat_axes[-1]
-    last_ax.set_visible(True)
-    last_ax.axis('off')
-
-    if comparison_df is not None:
-        err_gdf = gpd.GeoDataFrame(
-            comparison_df['date'],
-            geometry=list(
-                comparison_df['station'].map(lambda stn: geometry.Point(
-                    *station_location_df.loc[stn][['x', 'y']]))))
-        err_gdf['err'] = comparison_df['pred'] - comparison_df['obs']
-
-        if err_classes is None:
-            err_classes = ERR_CLASSES
-        err_gdf['err_class'] = np.digitize(err_gdf['err'], err_classes) - 1
-
-        palette = sns.color_palette('coolwarm', n_colors=len(err_classes) - 1)
-        cmap = colors.ListedColormap(palette)
-
-        # set black edge color for markers
-        plt.rcParams.update(**{'scatter.edgecolors': 'k'})
-
-        # plot the stations
-        for (_, date_gdf), ax in zip(err_gdf.groupby('date'), flat_axes):
-            date_gdf.plot(column='err_class', ax=ax, cmap=cmap)
-            # ax.set_xticks([])
-            # ax.set_yticks([])
-        # generate a legend and place it in the last (empty) axis
-        for start, end, color in zip(err_classes, err_classes[1:], palette):
-            last_ax.plot(0, 0, 'o', c=color, label=f'[{start}, {end})')
-        last_ax.legend(
-            loc='center',
-            facecolor='white',
-            title='Regression error $\hat{T} - T_{obs}$ [$\degree$C]')
-        fig.colorbar(g._mappables[-1],
-                     ax=last_ax,
-                     label='Map temperature $\hat{T}$ [$\degree$C]',
-                     shrink=.45)
+# I/O
+# chunk layouts of the dumped (time, y, x) arrays: in a "tile" layout, each
+# chunk holds a spatial tile of a single date (suited to reading the scenes of
+# a few dates), whereas in a "time" layout each chunk holds the whole time
+# series of a spatial tile (suited to reading pixel time series)
+CHUNK_LAYOUTS = ['tile', 'time']
+CHUNK_TILE_SIZE = 256
+COMPLEVEL = 4
+
+# REGRIDDING
+# persistent cache of the regridding weights
+REGRID_CACHE_DIR = environ.get(
+    'REGRID_CACHE_DIR',
+    path.join(path.expanduser('~'), '.cache', 'lausanne-heat-islands',
+              'regrid'))
+REGRID_INTERPS = ['nearest', 'linear']
+
+# REGIONS OF INTEREST
+# persistent cache of the (bit-packed) rasterized region masks
+ROI_MASK_CACHE_DIR = environ.get(
+    'ROI_MASK_CACHE_DIR',
+    path.join(path.expanduser('~'), '.cache', 'lausanne-heat-islands',
+              'roi-masks'))
+# number of region masks that are kept in memory (the least recently used are
+# dropped first)
+ROI_MASK_MEMORY_CACHE_SIZE = 16
+
+# STAGE CACHE
+# parameters of the `make_*` commands that do not affect the contents of
+# their outputs, and are thus ignored when keying the stage cache
+STAGE_CACHE_IGNORE_PARAMS = [
+    'dst_filepath', 'traces_filepath', 'n_jobs', 'cache_dir', 'store_dir',
+    'ref_et_cache_dir', 'roi_mask_cache_dir', 'evaluation_cache_filepath',
+    'checkpoint_dir', 'checkpoint_every', 'resume'
+]
+# packages whose (imported) source is hashed into the key, i.e., this package
+# and the dependencies that are installed from a git commit (so that their
+# version does not change along with their code)
+STAGE_CACHE_SOURCE_PACKAGES = ['lausanne_heat_islands', 'swiss_uhi_utils']
+# distributions whose version is included in the key since the outputs depend
+# on their behaviour
+STAGE_CACHE_KEY_DISTRIBUTIONS = [
+    'numpy', 'pandas', 'scipy', 'xarray', 'scikit-learn', 'rasterio',
+    'pyproj', 'geopandas', 'salem', 'pylandsat', 'natcap.invest',
+    'invest-ucm-calibration'
+]
+# maximum size (in bytes) of the stage cache, whose least recently used
+# entries are evicted
+STAGE_CACHE_MAX_SIZE = int(environ.get('STAGE_CACHE_MAX_SIZE', 2**34))
+
+
+def get_file_hash(filepath):
+    # hash of the contents of a file, e.g., to key cached results derived
+    # from it
+    hasher = hashlib.sha1()
+    with open(filepath, 'rb') as src:
+        for block in iter(lambda: src.read(2**20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _get_input_hash(filepath):
+    # hash of an input of a `make_*` command, which can be a directory (e.g.,
+    # the raw station data) or a shapefile, whose sidecar files (e.g., .dbf,
+    # .prj) are also hashed
+    if path.isdir(filepath):
+        filepaths = sorted(
+            path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(filepath)
+            for filename in filenames)
+    elif filepath.endswith('.shp'):
+        filepaths = sorted(glob.glob(f'{path.splitext(filepath)[0]}.*'))
+    else:
+        return get_file_hash(filepath)
+    return hashlib.sha1(
+        json.dumps([[path.relpath(_filepath, filepath),
+                     get_file_hash(_filepath)]
+                    for _filepath in filepaths]).encode()).hexdigest()
+
+
+def _get_source_hash():
+    # hash of the source of the running stage, i.e., the modules of
+    # `STAGE_CACHE_SOURCE_PACKAGES` that have been imported (including the
+    # `make_*` script)
+    filepaths = sorted({
+        module.__file__
+        for module_name, module in list(sys.modules.items())
+        if (module_name == '__main__' or module_name.split('.')[0] in
+            STAGE_CACHE_SOURCE_PACKAGES)
+        and getattr(module, '__file__', None) is not None
+    })
+    return hashlib.sha1(
+        json.dumps([[path.basename(filepath),
+                     get_file_hash(filepath)]
+                    for filepath in filepaths]).encode()).hexdigest()
+
+
+def _get_distribution_versions():
+    # versions of the `STAGE_CACHE_KEY_DISTRIBUTIONS` (None if not installed)
+    try:
+        from importlib import metadata
+        get_version = metadata.version
+        not_found_error = metadata.PackageNotFoundError
+    except ImportError:
+        # python < 3.8
+        import pkg_resources
+
+        def get_version(distribution):
+            return pkg_resources.get_distribution(distribution).version
+
+        not_found_error = pkg_resources.DistributionNotFound
+
+    versions = {}
+    for distribution in STAGE_CACHE_KEY_DISTRIBUTIONS:
+        try:
+            versions[distribution] = get_version(distribution)
+        except not_found_error:
+            versions[distribution] = None
+    return versions
+
+
+def _get_dir_size(dir_path):
+    return sum(
+        path.getsize(path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(dir_path)
+        for filename in filenames)
+
+
+def _evict_stage_cache(cache_dir, max_size, keep_entry_dir):
+    # delete the least recently used entries (the entries are touched when
+    # restored) until the cache size is below `max_size`, never deleting
+    # `keep_entry_dir`. The entries are renamed before being deleted so that
+    # other processes never restore a partially deleted entry
+    entry_dirs = [
+        entry_dir for entry_dir in glob.glob(path.join(cache_dir, '*'))
+        if not entry_dir.endswith('.tmp') and path.isdir(entry_dir)
+    ]
+    size_dict = {
+        entry_dir: _get_dir_size(entry_dir)
+        for entry_dir in entry_dirs
+    }
+    cache_size = sum(size_dict.values())
+    for entry_dir in sorted(entry_dirs, key=path.getmtime):
+        if cache_size <= max_size:
+            break
+        if entry_dir == keep_entry_dir:
+            continue
+        tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+        try:
+            os.replace(entry_dir, tmp_dir)
+        except OSError:
+            # another process evicted it in the meantime
+            continue
+        shutil.rmtree(tmp_dir)
+        cache_size -= size_dict[entry_dir]
+
+
+def _copy_output(src_filepath, dst_filepath):
+    # outputs can be files or directories (e.g., Zarr stores). Do not
+    # preserve the modification times so that the restored outputs are newer
+    # than their inputs (for make)
+    if path.isdir(dst_filepath):
+        shutil.rmtree(dst_filepath)
+    if path.isdir(src_filepath):
+        shutil.copytree(src_filepath, dst_filepath, copy_function=shutil.copy)
+    else:
+        shutil.copy(src_filepath, dst_filepath)
+
+
+def stage_cache(get_dst_filepaths=None, bypass_params=None):
+    # decorator for the `main` of a `make_*` command (below its click
+    # options) that adds a `--stage-cache-dir` option (which can also be set
+    # with the `STAGE_CACHE_DIR` environment variable). The cache is opt-in:
+    # when provided, the outputs of the command are cached and keyed by the
+    # contents of its input files (arguments/options of type
+    # `click.Path(exists=True)`), the rest of its parameters (except
+    # `STAGE_CACHE_IGNORE_PARAMS`), its source and the versions of its key
+    # dependencies, so that further runs with the same key restore the
+    # outputs instead of recomputing them, regardless of the file
+    # modification times. The least recently used entries are evicted so
+    # that the cache does not exceed `STAGE_CACHE_MAX_SIZE` (the cache
+    # directory can also be deleted at any time). `get_dst_filepaths` maps
+    # the command's keyword arguments to the list of its output files (by
+    # default, the `dst_filepath` argument), and the cache is bypassed when
+    # any of the flags of `bypass_params` is set (e.g., when the output
+    # depends on its previous contents)
+    if get_dst_filepaths is None:
+
+        def get_dst_filepaths(kwargs):
+            return [kwargs['dst_filepath']]
+
+    if bypass_params is None:
+        bypass_params = []
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            stage_cache_dir = kwargs.pop('stage_cache_dir')
+            if stage_cache_dir is None or any(
+                    kwargs[param] for param in bypass_params):
+                return func(**kwargs)
+
+            logger = logging.getLogger(func.__module__)
+            dst_filepaths = get_dst_filepaths(kwargs)
+            input_params = [
+                param.name for param in click.get_current_context().command.
+                params if isinstance(param.type, click.Path)
+                and param.type.exists and kwargs.get(param.name) is not None
+            ]
+            key = hashlib.sha1(
+                json.dumps(
+                    {
+                        'inputs': {
+                            param: _get_input_hash(kwargs[param])
+                            for param in input_params
+                        },
+                        'params': {
+                            param: value
+                            for param, value in kwargs.items()
+                            if param not in input_params
+                            and param not in STAGE_CACHE_IGNORE_PARAMS
+                        },
+                        'source': _get_source_hash(),
+                        'distributions': _get_distribution_versions(),
+                        'num_outputs': len(dst_filepaths)
+                    },
+                    sort_keys=True,
+                    default=str).encode()).hexdigest()
+
+            entry_dir = path.join(stage_cache_dir, key)
+            if path.exists(entry_dir):
+                try:
+                    # mark the entry as recently used
+                    os.utime(entry_dir)
+                    for i, dst_filepath in enumerate(dst_filepaths):
+                        _copy_output(path.join(entry_dir, str(i)),
+                                     dst_filepath)
+                        logger.info("restored %s from stage cache %s",
+                                    dst_filepath, entry_dir)
+                    return
+                except FileNotFoundError:
+                    # the entry has been evicted by another process in the
+                    # meantime
+                    logger.info("stage cache entry %s has been evicted",
+                                entry_dir)
+
+            func(**kwargs)
+            # copy the outputs to a temporary directory first so that
+            # concurrent processes never see a partially written entry
+            tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+            os.makedirs(tmp_dir)
+            for i, dst_filepath in enumerate(dst_filepaths):
+                _copy_output(dst_filepath, path.join(tmp_dir, str(i)))
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # another process stored the same entry in the meantime
+                shutil.rmtree(tmp_dir)
+            logger.info("stored outputs in stage cache %s", entry_dir)
+            _evict_stage_cache(stage_cache_dir, STAGE_CACHE_MAX_SIZE,
+                               entry_dir)
+
+        return click.option('--stage-cache-dir',
+                            type=click.Path(),
+                            envvar='STAGE_CACHE_DIR')(wrapper)
+
+    return decorator
+
+
+def _get_chunks(ds, chunk_layout):
+    if chunk_layout not in CHUNK_LAYOUTS:
+        raise ValueError(f"`chunk_layout` must be one of {CHUNK_LAYOUTS}")
+    return {
+        dim: (1 if chunk_layout == 'tile' else size)
+        if dim == 'time' else min(size, CHUNK_TILE_SIZE)
+        for dim, size in ds.sizes.items()
+    }
+
+
+def dump_dataset(ds, dst_filepath, chunk_layout='tile', complevel=COMPLEVEL):
+    # dump a dataset (or data array) to a chunked and compressed file, i.e.,
+    # a Zarr store if `dst_filepath` ends with ".zarr" and a NetCDF4 file
+    # otherwise. Existing files are overwritten.
+    if isinstance(ds, xr.DataArray):
+        # use the same default name as `xr.DataArray.to_netcdf` so that
+        # unnamed data arrays can also be read with `xr.open_dataarray`
+        ds = ds.to_dataset(name=ds.name if ds.name is not None else
+                           '__xarray_dataarray_variable__')
+    # get rid of the encoding of the source (e.g., the chunks of the file
+    # from which `ds` has been read) so that it does not conflict with ours
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding = {}
+    chunks = _get_chunks(ds, chunk_layout)
+
+    if path.isdir(dst_filepath):
+        shutil.rmtree(dst_filepath)
+    elif path.exists(dst_filepath):
+        os.remove(dst_filepath)
+    if dst_filepath.endswith('.zarr'):
+        # the dask chunks must match the Zarr chunks
+        ds.chunk(chunks).to_zarr(dst_filepath, mode='w')
+    else:
+        ds.to_netcdf(dst_filepath,
+                     encoding={
+                         data_var: dict(zlib=True,
+                                        complevel=complevel,
+                                        chunksizes=tuple(
+                                            chunks[dim]
+                                            for dim in ds[data_var].dims))
+                         for data_var in ds.data_vars
+                     })
+
+
+def open_dataset(filepath, **kwargs):
+    # lazily open a dataset dumped by `dump_dataset`, i.e., the data is only
+    # read (in chunks) when needed, so that only the selected dates/windows
+    # are read from disk
+    if filepath.rstrip('/').endswith('.zarr'):
+        return xr.open_zarr(filepath, **kwargs)
+    return xr.open_dataset(filepath, chunks={}, **kwargs)
+
+
+def open_dataarray(filepath, **kwargs):
+    # lazily open a data array dumped by `dump_dataset`
+    ds = open_dataset(filepath, **kwargs)
+    data_var, = ds.data_vars
+    return ds[data_var]
+
 
+def _get_grid(obj):
+    # importing salem registers its xarray accessors
+    import salem  # noqa: F401
+    return obj.salem.grid
+
+
+def get_ref_da(geom, dst_res, dst_fill=0, dst_crs=CRS):
+    # get a reference (y, x) data array filled with `dst_fill` whose grid of
+    # resolution `dst_res` covers the bounds of `geom` (in `dst_crs`). The
+    # grid is aligned to multiples of `dst_res` so that the grids of nested
+    # resolutions are consistent
+    import salem
+
+    west, south, east, north = geom.bounds
+    west, south = (math.floor(bound / dst_res) * dst_res
+                   for bound in (west, south))
+    east, north = (math.ceil(bound / dst_res) * dst_res
+                   for bound in (east, north))
+    nx, ny = (int(round(length / dst_res))
+              for length in (east - west, north - south))
+    return xr.DataArray(
+        np.full((ny, nx), dst_fill),
+        dims=('y', 'x'),
+        coords={
+            'y': north - dst_res * (np.arange(ny) + .5),
+            'x': west + dst_res * (np.arange(nx) + .5)
+        },
+        attrs={'pyproj_srs': salem.check_crs(dst_crs).srs})
+
+
+def _get_grid_key(grid):
+    grid = grid.center_grid
+    return dict(proj=grid.proj.srs,
+                nx=grid.nx,
+                ny=grid.ny,
+                x0=grid.x0,
+                y0=grid.y0,
+                dx=grid.dx,
+                dy=grid.dy)
+
+
+def _compute_regrid_weights(src_grid, dst_grid, interp):
+    # sparse (dst pixels, src pixels) matrix so that the regridded values are
+    # obtained by multiplying it by the flat source values, and mask of the
+    # destination pixels that fall within the source grid. The pixel centers
+    # are mapped as in `salem.Grid.map_gridded_data`
+    from scipy import sparse
+
+    i, j = dst_grid.center_grid.ij_coordinates
+    oi, oj = src_grid.center_grid.transform(i,
+                                            j,
+                                            crs=dst_grid.center_grid,
+                                            nearest=interp == 'nearest',
+                                            maskout=False)
+    oi, oj = oi.ravel(), oj.ravel()
+    nx, ny = src_grid.nx, src_grid.ny
+    shape = (oi.size, nx * ny)
+    if interp == 'nearest':
+        valid_mask = (oi >= 0) & (oi < nx) & (oj >= 0) & (oj < ny)
+        rows = np.flatnonzero(valid_mask)
+        weights = sparse.csr_matrix(
+            (np.ones(len(rows)),
+             (rows, oj[valid_mask] * nx + oi[valid_mask])),
+            shape=shape)
+        return weights, valid_mask
+
+    # bilinear interpolation from the four surrounding source pixels
+    valid_mask = (oi >= 0) & (oi <= nx - 1) & (oj >= 0) & (oj <= ny - 1)
+    rows = np.flatnonzero(valid_mask)
+    oi, oj = oi[valid_mask], oj[valid_mask]
+    i0 = np.clip(np.floor(oi), 0, max(nx - 2, 0)).astype(int)
+    j0 = np.clip(np.floor(oj), 0, max(ny - 2, 0)).astype(int)
+    fi, fj = oi - i0, oj - j0
+    data, row_ind, col_ind = [], [], []
+    for di, dj, corner_weights in [(0, 0, (1 - fi) * (1 - fj)),
+                                   (1, 0, fi * (1 - fj)),
+                                   (0, 1, (1 - fi) * fj), (1, 1, fi * fj)]:
+        # skip the null weights so that they do not propagate nan values
+        nonzero = corner_weights > 0
+        data.append(corner_weights[nonzero])
+        row_ind.append(rows[nonzero])
+        col_ind.append((j0[nonzero] + dj) * nx + i0[nonzero] + di)
+    weights = sparse.csr_matrix(
+        (np.concatenate(data),
+         (np.concatenate(row_ind), np.concatenate(col_ind))),
+        shape=shape)
+    return weights, valid_mask
+
+
+def get_regrid_weights(src_grid, dst_grid, interp='linear', cache_dir=None):
+    # get the regridding weights from `src_grid` to `dst_grid` (salem grids)
+    # from the persistent cache (keyed by both grids and the interpolation),
+    # computing (and caching) them only if they are not there yet
+    from scipy import sparse
+
+    if interp not in REGRID_INTERPS:
+        raise ValueError(f"`interp` must be one of {REGRID_INTERPS}")
+    if cache_dir is None:
+        cache_dir = REGRID_CACHE_DIR
+
+    key = hashlib.sha1(
+        json.dumps([
+            _get_grid_key(src_grid),
+            _get_grid_key(dst_grid), interp
+        ],
+                   sort_keys=True).encode()).hexdigest()
+    weights_filepath = path.join(cache_dir, f'{key}.npz')
+    if path.exists(weights_filepath):
+        with np.load(weights_filepath) as src:
+            return sparse.csr_matrix(
+                (src['data'], src['indices'], src['indptr']),
+                shape=tuple(src['shape'])), src['valid_mask']
+
+    weights, valid_mask = _compute_regrid_weights(src_grid, dst_grid, interp)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that concurrent processes never see
+    # a partially written file (note that `np.savez` appends ".npz")
+    tmp_filepath = f'{weights_filepath}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_filepath,
+             data=weights.data,
+             indices=weights.indices,
+             indptr=weights.indptr,
+             shape=weights.shape,
+             valid_mask=valid_mask)
+    os.replace(tmp_filepath, weights_filepath)
+    return weights, valid_mask
+
+
+def regrid(ref_obj, other, interp='linear', cache_dir=None):
+    # regrid the (y, x) variables of the dataset (or data array) `other` onto
+    # the grid of `ref_obj`, like `ref_obj.salem.transform(other,
+    # interp=interp)` but with cached weights and a single sparse
+    # multiplication for all the variables and time steps. As with salem, the
+    # regridded values are float64 and nan outside the source grid
+    dst_grid = _get_grid(ref_obj)
+    weights, valid_mask = get_regrid_weights(_get_grid(other),
+                                             dst_grid,
+                                             interp=interp,
+                                             cache_dir=cache_dir)
+
+    was_dataarray = isinstance(other, xr.DataArray)
+    if was_dataarray:
+        ds = other.to_dataset(name=other.name if other.name is not None else
+                              '__xarray_dataarray_variable__')
     else:
-        station_gser = gpd.GeoSeries(
-            gpd.points_from_xy(station_location_df['x'],
-                               station_location_df['y']))
-
-        # invisibly plot the stations in each map axis just so that the axis
-        # limits and aspect ratio are set correctly
-        for ax in flat_axes[:-1]:
-            station_gser.plot(ax=ax, alpha=0)
-
-        fig.colorbar(g._mappables[-1],
-                     ax=last_ax,
-                     label='$\hat{T}_{sr} - \hat{T}_{ucm}$ [$\degree$C]',
-                     orientation='horizontal',
-                     fraction=.55,
-                     shrink=.8,
-                     boundaries=ERR_BOUNDARIES)
-
-    # g.add_colorbar()
-    fig.subplots_adjust(hspace=-.5)
-    # fig.savefig('../reports/figures/spatial-regression-maps.png')
-    return g
-
-
-def plot_comparison_hists(T_diff_da, station_tair_df):
-    # figwidth, figheight = plt.rcParams['figure.figsize']
-    # fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(2 * figwidth, figheight))
-    fig, ax = plt.subplots()
-
-    # histograms by date
-    # for date in T_diff_da['time']:
-    #     sns.distplot(T_diff_da.sel(time=date),
-    #                  label=pd.to_datetime(date.item()).strftime('%d-%m-%Y'),
-    #                  ax=ax)
-    sns.distplot(T_diff_da, ax=ax)
-    ax.set_ylabel('$P \; (\hat{T}_{sr} - \hat{T}_{ucm})$')
-    ax.set_xlabel('$\hat{T}_{sr} - \hat{T}_{ucm}$')
-    # ax.legend(loc='center right', bbox_to_anchor=(1.4, .5))
-    # axin2 = ax.inset_axes([.72, .75, .24, .2])
-
-    # diff vs observed temperature in inset
-    # [.04, .75, .24, .2]
-    axin = ax.inset_axes([.72, .72, .24, .24])
-    sns.scatterplot(
-        x=station_tair_df.mean(axis=1),
-        y=T_diff_da.mean(['x', 'y']),
-        hue=pd.to_datetime(T_diff_da['time'].values).strftime('%d-%m-%Y'),
-        # alpha=0.4,  # default for seaborn distplots
-        # legend=False,
-        ax=axin)
-    axin.axhline(color='gray', linestyle='--', linewidth=1)
-    axin.set_ylim([-3, 3])
-    axin.set_yticks([-2, 0, 2])
-    axin.set_ylabel('$\hat{\mu}$', rotation=0, verticalalignment='center')
-    axin.set_xlabel('$T_{obs}$')
-    # place the inset axis' legend outside the main axis
-    handles, labels = axin.get_legend_handles_labels()
-    ax.legend(handles, labels, loc='center right', bbox_to_anchor=(1.34, .5))
-    axin.get_legend().remove()
-
-    # # overall histogram in inset
-    # axin2 = ax.inset_axes([.72, .75, .24, .2])
-    # sns.distplot(T_diff_da, ax=axin2)
-    # axin2.set_ylabel('')
-    # axin2.set_yticks([])
-    # axin2.set_xlabel('')
-
-    return fig
+        ds = other
+    # stack the flat (y, x) arrays of all the variables into a single
+    # (src pixels, arrays) matrix
+    data_vars = [
+        data_var for data_var in ds.data_vars
+        if {'y', 'x'}.issubset(ds[data_var].dims)
+    ]
+    das = [
+        ds[data_var].transpose(
+            *[dim for dim in ds[data_var].dims if dim not in ('y', 'x')], 'y',
+            'x') for data_var in data_vars
+    ]
+    src_arrs = [
+        da.values.reshape(-1, da.shape[-2] * da.shape[-1]) for da in das
+    ]
+    dst_arr = weights.dot(np.concatenate(src_arrs).T).T
+    dst_arr[:, ~valid_mask] = np.nan
+
+    out = ds.drop_vars(data_vars).drop_vars(['y', 'x'], errors='ignore')
+    start = 0
+    for data_var, da, src_arr in zip(data_vars, das, src_arrs):
+        _dst_arr = dst_arr[start:start + len(src_arr)]
+        start += len(src_arr)
+        coords = {
+            coord: da.coords[coord]
+            for coord in da.coords if coord not in ('y', 'x')
+        }
+        coords.update(y=ref_obj['y'], x=ref_obj['x'])
+        out[data_var] = xr.DataArray(_dst_arr.reshape(
+            da.shape[:-2] + (dst_grid.ny, dst_grid.nx)),
+                                     dims=da.dims,
+                                     coords=coords,
+                                     attrs=da.attrs)
+        out[data_var].attrs['pyproj_srs'] = dst_grid.proj.srs
+
+    if was_dataarray:
+        return out[data_var]
+    out.attrs['pyproj_srs'] = dst_grid.proj.srs
+    return out
+
+
+# region masks of the current process, keyed as in the persistent cache and
+# ordered from the least to the most recently used
+_roi_mask_dict = collections.OrderedDict()
+
+
+def _get_roi_mask_key(grid, geometry, crs):
+    return hashlib.sha1(
+        json.dumps([_get_grid_key(grid),
+                    hashlib.sha1(geometry.wkb).hexdigest(),
+                    str(crs)],
+                   sort_keys=True).encode()).hexdigest()
+
+
+def _dump_roi_mask(mask, mask_filepath):
+    # write to a temporary file first so that concurrent processes never see
+    # a partially written file (note that `np.savez` appends ".npz")
+    os.makedirs(path.dirname(mask_filepath), exist_ok=True)
+    tmp_filepath = f'{mask_filepath}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_filepath, bits=np.packbits(mask), shape=mask.shape)
+    os.replace(tmp_filepath, mask_filepath)
+
+
+def _set_roi_mask(key, mask):
+    _roi_mask_dict[key] = mask
+    _roi_mask_dict.move_to_end(key)
+    while len(_roi_mask_dict) > ROI_MASK_MEMORY_CACHE_SIZE:
+        _roi_mask_dict.popitem(last=False)
+
+
+def get_roi_mask(grid, geometry, crs, cache_dir=None):
+    # get the boolean mask of the pixels of `grid` (a salem grid) that are
+    # within `geometry` (as in salem's `roi` and `subset`). Each (grid,
+    # geometry) pair is only rasterized once: the masks are kept in a
+    # persistent cache as bit-packed arrays, and the most recently used ones
+    # also in memory
+    if cache_dir is None:
+        cache_dir = ROI_MASK_CACHE_DIR
+
+    key = _get_roi_mask_key(grid, geometry, crs)
+    mask = _roi_mask_dict.get(key)
+    if mask is not None:
+        _roi_mask_dict.move_to_end(key)
+        return mask
+    mask_filepath = path.join(cache_dir, f'{key}.npz')
+    if path.exists(mask_filepath):
+        with np.load(mask_filepath) as src:
+            shape = tuple(src['shape'])
+            mask = np.unpackbits(
+                src['bits'])[:shape[0] * shape[1]].reshape(shape).astype(bool)
+    else:
+        mask = grid.region_of_interest(geometry=geometry,
+                                       crs=crs).astype(bool)
+        _dump_roi_mask(mask, mask_filepath)
+    _set_roi_mask(key, mask)
+    return mask
+
+
+def subset(obj, geometry, crs, margin=0, cache_dir=None):
+    # crop the dataset (or data array) `obj` to the bounding box of the pixels
+    # within `geometry` (plus `margin` pixels), like `obj.salem.subset`
+    mask = get_roi_mask(_get_grid(obj), geometry, crs, cache_dir=cache_dir)
+    rows, cols = np.nonzero(mask)
+    row_slice = slice(max(rows.min() - margin, 0), rows.max() + margin + 1)
+    col_slice = slice(max(cols.min() - margin, 0), cols.max() + margin + 1)
+    out = obj.isel(y=row_slice, x=col_slice)
+    # the mask of the subset grid is just a window of the mask, so store it
+    # right away so that a subsequent `roi` does not need to rasterize again
+    if margin <= 0:
+        key = _get_roi_mask_key(_get_grid(out), geometry, crs)
+        if key not in _roi_mask_dict:
+            # copy so that the (view of the) window does not keep the whole
+            # mask in memory once the latter is dropped
+            subset_mask = mask[row_slice, col_slice].copy()
+            _set_roi_mask(key, subset_mask)
+            _dump_roi_mask(
+                subset_mask,
+                path.join(cache_dir or ROI_MASK_CACHE_DIR, f'{key}.npz'))
+    return out
+
+
+def roi(obj, geometry, crs, cache_dir=None):
+    # set the pixels of the dataset (or data array) `obj` outside `geometry`
+    # to nan, like `obj.salem.roi`
+    grid = _get_grid(obj)
+    mask = get_roi_mask(grid, geometry, crs, cache_dir=cache_dir)
+    out = obj.where(xr.DataArray(mask, dims=('y', 'x')))
+    # keep the attributes and encoding, and set the projection everywhere
+    out.attrs = obj.attrs.copy()
+    out.attrs['pyproj_srs'] = grid.proj.srs
+    out.encoding = obj.encoding
+    if isinstance(out, xr.Dataset):
+        for var in obj.variables:
+            out[var].encoding = obj[var].encoding
+        for data_var in out.data_vars:
+            out[data_var].attrs = obj[data_var].attrs.copy()
+            out[data_var].attrs['pyproj_srs'] = grid.proj.srs
+    return out
+
+
+def get_res_filepaths(dst_filepath, dst_res_list):
+    # map each resolution to the filepath where its output is dumped, i.e.,
+    # `dst_filepath` if there is a single resolution and otherwise
+    # `dst_filepath` with a resolution suffix, e.g., "tair-maps-100.nc"
+    if len(dst_res_list) == 1:
+        return {dst_res_list[0]: dst_filepath}
+    root, ext = path.splitext(dst_filepath.rstrip('/'))
+    return {dst_res: f'{root}-{dst_res}{ext}' for dst_res in dst_res_list}
+
+
+def get_block_factor(src_res, dst_res):
+    # number of pixels of resolution `src_res` along each side of a pixel of
+    # resolution `dst_res`, which must be an integer multiple of `src_res`
+    block_factor = dst_res / src_res
+    if not np.isclose(block_factor, np.round(block_factor)):
+        raise ValueError(
+            f"resolution {dst_res} is not a multiple of {src_res}")
+    return int(np.round(block_factor))
+
+
+def _get_block_anchor(coords, dst_res, block_factor):
+    # snap the first edge of the pixels of `coords` to a multiple of
+    # `dst_res` (towards the outside of the grid) and return the snapped edge
+    # as well as the number of pixels by which `coords` are offset from it
+    res = coords[1] - coords[0]
+    edge = coords[0] - res / 2
+    num_blocks = edge / dst_res
+    if np.isclose(num_blocks, np.round(num_blocks)):
+        num_blocks = np.round(num_blocks)
+    anchor = dst_res * (math.floor(num_blocks)
+                        if res > 0 else math.ceil(num_blocks))
+    offset = (edge - anchor) / res
+    if not np.isclose(offset, np.round(offset)):
+        raise ValueError(
+            f"the grid is not aligned to multiples of its resolution {res}")
+    return anchor, int(np.round(offset)) % block_factor
+
+
+def block_average(da, dst_res, ref_obj=None):
+    # aggregate the (..., y, x) data array `da` to the coarser resolution
+    # `dst_res` by averaging the valid (non-nan) pixels of each block, so that
+    # the aggregates are area-weighted. The blocks are snapped to multiples of
+    # `dst_res` (like the grids of `get_ref_da`), hence the grids obtained
+    # from different inputs and for nested resolutions are consistent. The
+    # partial blocks at the edges average the pixels that they contain. If
+    # `ref_obj` is provided, the result is reindexed to its (y, x) grid, which
+    # must be aligned to multiples of `dst_res` (nan outside `da`)
+    x, y = da['x'].values, da['y'].values
+    res_x, res_y = x[1] - x[0], y[1] - y[0]
+    block_factor = get_block_factor(abs(res_x), dst_res)
+    if block_factor > 1:
+        da = da.transpose(
+            *[dim for dim in da.dims if dim not in ('y', 'x')], 'y', 'x')
+        extra_shape = da.shape[:-2]
+        (anchor_y, offset_y), (anchor_x, offset_x) = (_get_block_anchor(
+            coords, dst_res, block_factor) for coords in (y, x))
+        dst_ny, dst_nx = (-(-(offset + len(coords)) // block_factor)
+                          for offset, coords in ((offset_y, y),
+                                                 (offset_x, x)))
+        arr = np.full(
+            extra_shape + (dst_ny * block_factor, dst_nx * block_factor),
+            np.nan)
+        arr[..., offset_y:offset_y + len(y),
+            offset_x:offset_x + len(x)] = da.values
+        arr = arr.reshape(extra_shape +
+                          (dst_ny, block_factor, dst_nx, block_factor))
+        valid_arr = ~np.isnan(arr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dst_arr = np.where(valid_arr, arr, 0).sum(
+                axis=(-3, -1)) / valid_arr.sum(axis=(-3, -1))
+        if np.issubdtype(da.dtype, np.floating):
+            dst_arr = dst_arr.astype(da.dtype)
+
+        # coordinates of the block centers
+        coords = {dim: da[dim] for dim in da.dims[:-2] if dim in da.coords}
+        coords['y'] = anchor_y + res_y * block_factor * (np.arange(dst_ny) +
+                                                         .5)
+        coords['x'] = anchor_x + res_x * block_factor * (np.arange(dst_nx) +
+                                                         .5)
+        da = xr.DataArray(dst_arr,
+                          dims=da.dims,
+                          coords=coords,
+                          name=da.name,
+                          attrs=da.attrs)
+
+    if ref_obj is not None:
+        # both grids are aligned to multiples of `dst_res`, so the tolerance
+        # only absorbs the floating point error of the coordinates
+        da = da.reindex(y=ref_obj['y'].values,
+                        x=ref_obj['x'].values,
+                        method='nearest',
+                        tolerance=dst_res / 4)
+    return da